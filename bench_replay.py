@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+bench_replay.py
+Offline replay / benchmark for the monitoring pipeline.
+
+Feeds recorded (or synthetic) NextDNS /logs pages through the same path the monitor
+uses - streaming page parse + cursor advance -> collect_alerts (denylist match, dedupe) ->
+alert queue -> dispatcher - with Telegram stubbed out, and reports throughput,
+per-page latency and peak memory for each denylist size.
+
+Recordings are JSONL, one /logs API response per line ({"data": [...], "meta": {...}}).
+A denylist file is either a /denylist API response (JSON) or plain text, one domain per line.
+
+    python bench_replay.py --denylist-sizes 100,10000,100000
+    python bench_replay.py --logs recorded_pages.jsonl --denylist denylist.json --state-backend sqlite
+    python bench_replay.py --denylist-sizes 10000 --stages
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+from typing import Dict, Any, List
+
+import v1
+
+PROFILE_ID = "bench"
+ACCOUNT_NAME = "Bench"
+
+
+# -------------------- Inputs --------------------
+def load_pages(path: str) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_denylist(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    try:
+        return v1.NextDNSManager.parse_denylist(json.loads(text))
+    except ValueError:
+        return [line.strip().lower() for line in text.splitlines() if line.strip() and not line.startswith("#")]
+
+
+def synthetic_denylist(size: int, rng: random.Random) -> list:
+    return ["ads{}.tracker{}.com".format(i, rng.randrange(1000)) for i in range(size)]
+
+
+def synthetic_pages(pages: int, page_size: int, denylist: list, block_ratio: float, match_ratio: float,
+                    rng: random.Random) -> List[Dict[str, Any]]:
+    """/logs responses in ascending time order; match_ratio of the lines hit the denylist (directly or a subdomain)."""
+    ts = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    out = []
+    for _ in range(pages):
+        data = []
+        for _ in range(page_size):
+            ts += timedelta(milliseconds=rng.randrange(1, 50))
+            if denylist and rng.random() < match_ratio:
+                name = rng.choice(denylist)
+                if rng.random() < 0.5:
+                    name = "www." + name
+                status = "blocked"
+            else:
+                name = "host{}.site{}.net".format(rng.randrange(100), rng.randrange(5000))
+                status = "blocked" if rng.random() < block_ratio else "default"
+            data.append({
+                "timestamp": ts.isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+                "domain": name,
+                "status": status,
+                "clientIp": "10.0.0.{}".format(rng.randrange(1, 255)),
+                "device": {"id": "dev{}".format(rng.randrange(20)), "name": "Device {}".format(rng.randrange(20))},
+            })
+        out.append({"data": data, "meta": {"pagination": {"cursor": None}}})
+    return out
+
+
+# -------------------- Replay --------------------
+@contextlib.contextmanager
+def bench_environment():
+    """Run in a scratch directory (state files stay out of the repo) with the pipeline's prints silenced."""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+        os.chdir(tmp)
+        try:
+            with contextlib.redirect_stdout(devnull):
+                yield
+        finally:
+            os.chdir(cwd)
+
+
+def page_bodies(pages: List[Dict[str, Any]]) -> List[bytes]:
+    """Pages as the raw response bodies the monitor would read off the wire."""
+    return [json.dumps(page).encode("utf-8") for page in pages]
+
+
+def body_chunks(body: bytes):
+    for start in range(0, len(body), v1.LOG_STREAM_CHUNK_SIZE):
+        yield body[start:start + v1.LOG_STREAM_CHUNK_SIZE]
+
+
+def replay(pages: List[bytes], denylist: list, state_backend: str, trace: bool = False) -> Dict[str, Any]:
+    with bench_environment():
+        manager = v1.NextDNSManager(state_backend=state_backend, api_rps=0, trace=trace)
+        manager.accounts = {}
+        manager.bot_settings = {"bot_token": "bench", "chat_id": "bench"}
+        delivered = []
+        # Telegram stub: accept every message
+        manager.post_telegram = lambda text, parse_mode=None: (delivered.append(len(text)) or 200, None)
+
+        matcher = v1.DenylistMatcher(denylist)
+        latencies = []
+        lines = queued = 0
+        started = perf_counter()
+        for body in pages:
+            t0 = perf_counter()
+            cursor = manager.log_cursor(PROFILE_ID)
+            with manager.tracer.span("decode"):
+                _, entries = manager.read_log_page(cursor, body_chunks(body))
+            blocked, ingested = manager.commit_log_cursor(PROFILE_ID, cursor)
+            for alert in manager.collect_alerts(PROFILE_ID, ACCOUNT_NAME, blocked, matcher, ingested):
+                manager.queue_alert(alert)
+                queued += 1
+            # what a sender thread does with the queue
+            while len(manager.alert_queue):
+                for alert in manager.alert_queue.get_batch(timeout=0):
+                    manager.alerts.submit(alert.account_name, alert.domain, alert.reason, alert.client_ip)
+            manager.flush_alerts()
+            manager.alert_history.flush()  # the history writer thread's share
+            latencies.append(perf_counter() - t0)
+            lines += entries
+        manager.flush_alerts(force=True)
+        manager.save_state()
+        elapsed = perf_counter() - started
+        manager.state_store.close()
+        manager.alert_history.close()
+        manager.snapshot_pool.shutdown(wait=False)
+
+    return {
+        "lines": lines,
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "alerts": queued,
+        "messages": len(delivered),
+        "stages": manager.tracer.report()["stages"],
+    }
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))]
+
+
+def peak_memory(pages: List[bytes], denylist: list, state_backend: str) -> int:
+    """Peak bytes allocated by a replay; a separate pass so tracing doesn't skew the timings."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        replay(pages, denylist, state_backend)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# -------------------- CLI --------------------
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay NextDNS log pages through the monitoring pipeline")
+    parser.add_argument("--logs", help="JSONL of recorded /logs responses (default: synthetic pages)")
+    parser.add_argument("--denylist", help="denylist file, JSON API response or one domain per line "
+                                           "(default: synthetic lists of --denylist-sizes)")
+    parser.add_argument("--denylist-sizes", default="100,10000,100000",
+                        help="comma separated synthetic denylist sizes")
+    parser.add_argument("--pages", type=int, default=100, help="synthetic pages to generate")
+    parser.add_argument("--page-size", type=int, default=v1.LOG_PAGE_LIMIT, help="lines per synthetic page")
+    parser.add_argument("--block-ratio", type=float, default=0.3, help="share of non-matching lines that are blocked")
+    parser.add_argument("--match-ratio", type=float, default=0.02, help="share of lines hitting the denylist")
+    parser.add_argument("--state-backend", choices=v1.STATE_BACKENDS, default="json")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--stages", action="store_true", help="also print time per pipeline stage (v1 --trace spans)")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    recorded = load_pages(args.logs) if args.logs else None
+
+    if args.denylist:
+        denylists = [load_denylist(args.denylist)]
+    else:
+        denylists = [synthetic_denylist(int(size), rng) for size in args.denylist_sizes.split(",") if size.strip()]
+        if recorded:
+            # make some recorded blocks hit the synthetic list, as they would with the real one
+            names = sorted({l.get("domain") or l.get("name") or "" for p in recorded for l in p.get("data", [])
+                            if l.get("status") in (2, "blocked")} - {""})
+            sample = rng.sample(names, int(len(names) * args.match_ratio)) if names else []
+            denylists = [d + sample for d in denylists]
+
+    print(f"{'denylist':>10} {'lines':>9} {'lines/s':>11} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'alerts':>7} {'msgs':>6} {'peak MB':>8}")
+    for denylist in denylists:
+        pages = page_bodies(recorded or synthetic_pages(args.pages, args.page_size, denylist, args.block_ratio,
+                                                        args.match_ratio, rng))
+        result = replay(pages, denylist, args.state_backend, args.stages)
+        peak = "-" if args.no_memory else "{:.1f}".format(peak_memory(pages, denylist, args.state_backend) / 2 ** 20)
+        rate = result["lines"] / result["elapsed"] if result["elapsed"] else 0
+        print(f"{len(denylist):>10} {result['lines']:>9} {rate:>11,.0f} "
+              f"{percentile(result['latencies'], 50) * 1000:>8.2f} {percentile(result['latencies'], 99) * 1000:>8.2f} "
+              f"{result['alerts']:>7} {result['messages']:>6} {peak:>8}")
+        for stage, timing in result["stages"].items():
+            print(f"{'':>10} {stage:>12} {timing['count']:>7} x {timing['mean_ms']:>8.3f} ms "
+                  f"(max {timing['max_ms']:.3f} ms, total {timing['total_seconds']:.3f} s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+fake_nextdns.py
+Local stand-in for the NextDNS and Telegram APIs, for load-testing the monitor end to end.
+
+Serves the endpoints NextDNSManager uses - /profiles, /profiles/<id>/denylist,
+/profiles/<id>/logs, /profiles/<id>/logs/stream (server-sent events) and
+/bot<token>/sendMessage - for any number of synthetic
+profiles, with configurable log rates, latency, page sizes and injected 429s / 5xx.
+
+    python fake_nextdns.py --profiles 500 --keys 10 --write-accounts nextdns_accounts.json
+    python fake_nextdns.py --profiles 500 --keys 10 --log-rate 5 --rate-limit-ratio 0.01
+    NEXTDNS_API_BASE=http://127.0.0.1:8787 TELEGRAM_API_BASE=http://127.0.0.1:8787 python v1.py serve
+
+GET /stats returns request and message counters.
+"""
+
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, Any
+
+from flask import Flask, Response, jsonify, request
+
+app = Flask(__name__)
+config: argparse.Namespace = None
+profiles: Dict[str, "FakeProfile"] = {}
+stats_lock = threading.Lock()
+stats: Dict[str, int] = {}
+
+
+def count(name: str, value: int = 1):
+    with stats_lock:
+        stats[name] = stats.get(name, 0) + value
+
+
+def iso(ms: float) -> str:
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def parse_from(value: str) -> float:
+    """The logs API takes `from` as unix ms or an ISO timestamp."""
+    if not value:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() * 1000
+
+
+# -------------------- Synthetic profiles --------------------
+class FakeProfile:
+    """One profile: a fixed denylist and a log stream generated lazily at log_rate lines/sec."""
+
+    def __init__(self, profile_id: str, api_key: str, rng: random.Random):
+        self.id = profile_id
+        self.api_key = api_key
+        self.rng = rng
+        self.denylist = ["ads{}.tracker{}.com".format(i, profile_id) for i in range(config.denylist_size)]
+        self.logs: deque = deque()  # (seq, ms, entry), oldest first
+        self.seq = 0
+        self.generated_until = time.time() * 1000 - config.backlog * 1000
+        self.carry = 0.0
+        self.lock = threading.Lock()
+        body = json.dumps({"data": [{"id": d, "active": True} for d in self.denylist]})
+        self.denylist_body = body
+        self.denylist_etag = '"{}"'.format(hashlib.sha256(body.encode()).hexdigest()[:16])
+
+    def new_entry(self, ms: float) -> Dict[str, Any]:
+        if self.denylist and self.rng.random() < config.match_ratio:
+            name, status = self.rng.choice(self.denylist), "blocked"
+        else:
+            name = "host{}.site{}.net".format(self.rng.randrange(100), self.rng.randrange(5000))
+            status = "blocked" if self.rng.random() < config.block_ratio else "default"
+        device = self.rng.randrange(20)
+        return {
+            "timestamp": iso(ms),
+            "domain": name,
+            "root": ".".join(name.split(".")[-2:]),
+            "status": status,
+            "reasons": [{"id": "blocklist:custom", "name": "Denylist"}] if status == "blocked" else [],
+            "clientIp": "10.0.{}.{}".format(device, self.rng.randrange(1, 255)),
+            "protocol": "DNS-over-HTTPS",
+            "device": {"id": "dev{}".format(device), "name": "Device {}".format(device)},
+        }
+
+    def generate(self):
+        """Append the lines produced since the last call, then trim to the retention window."""
+        now = time.time() * 1000
+        elapsed = now - self.generated_until
+        if elapsed <= 0:
+            return
+        wanted = config.log_rate * elapsed / 1000 + self.carry
+        n = int(wanted)
+        self.carry = wanted - n
+        for i in range(n):
+            self.seq += 1
+            ms = self.generated_until + elapsed * (i + 1) / (n + 1)
+            self.logs.append((self.seq, ms, self.new_entry(ms)))
+        self.generated_until = now
+        horizon = now - config.retention * 1000
+        while self.logs and self.logs[0][1] < horizon:
+            self.logs.popleft()
+
+    def page(self, since_ms: float, ascending: bool, limit: int, cursor: str) -> Dict[str, Any]:
+        with self.lock:
+            self.generate()
+            if ascending:
+                after = int(cursor) if cursor else 0
+                matches = (e for e in self.logs if e[1] >= since_ms and e[0] >= after)
+            else:
+                before = int(cursor) if cursor else self.seq
+                matches = (e for e in reversed(self.logs) if e[1] >= since_ms and e[0] <= before)
+            selected = []
+            next_cursor = None
+            stream_id = self.seq
+            for entry in matches:
+                if len(selected) == limit:
+                    next_cursor = str(entry[0])
+                    break
+                selected.append(entry[2])
+                if ascending:
+                    stream_id = entry[0]
+        return {"data": selected, "meta": {"pagination": {"cursor": next_cursor}, "stream": {"id": str(stream_id)}}}
+
+    def since(self, after: int) -> list:
+        """(seq, entry) for every retained line after the given stream id."""
+        with self.lock:
+            self.generate()
+            return [(e[0], e[2]) for e in self.logs if e[0] > after]
+
+
+def build_profiles():
+    rng = random.Random(config.seed)
+    for i in range(config.profiles):
+        profile_id = "f{:05x}".format(i)
+        profiles[profile_id] = FakeProfile(profile_id, "fake-key-{}".format(i % config.keys), random.Random(rng.random()))
+
+
+def accounts_file_data() -> Dict[str, Dict[str, Any]]:
+    """nextdns_accounts.json content for the fake profiles."""
+    return {
+        pid: {
+            "name": "Load {}".format(pid),
+            "profile_name": pid,
+            "api_key": profile.api_key,
+            "added_at": datetime.now().strftime("%Y-%m-%d %I:%M:%S %p"),
+            "active": True,
+        }
+        for pid, profile in profiles.items()
+    }
+
+
+# -------------------- Fault injection --------------------
+def simulate(kind: str):
+    """Apply latency, then maybe answer with an injected error instead of the real response."""
+    if config.latency:
+        time.sleep(random.uniform(0, 2 * config.latency) / 1000)
+    roll = random.random()
+    if roll < config.rate_limit_ratio:
+        count(kind + "_429")
+        if kind == "telegram":
+            body = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry later",
+                    "parameters": {"retry_after": config.retry_after}}
+            return Response(json.dumps(body), status=429, mimetype="application/json")
+        return Response(json.dumps({"errors": [{"code": "tooManyRequests"}]}), status=429,
+                        mimetype="application/json", headers={"Retry-After": str(config.retry_after)})
+    if kind != "telegram" and roll < config.rate_limit_ratio + config.error_ratio:
+        count(kind + "_5xx")
+        return Response(json.dumps({"errors": [{"code": "internalError"}]}), status=503, mimetype="application/json")
+    return None
+
+
+def authorized_profile(profile_id: str):
+    profile = profiles.get(profile_id)
+    if profile is None:
+        return None, (jsonify({"errors": [{"code": "notFound"}]}), 404)
+    if request.headers.get("X-Api-Key") != profile.api_key:
+        return None, (jsonify({"errors": [{"code": "forbidden"}]}), 403)
+    return profile, None
+
+
+# -------------------- NextDNS endpoints --------------------
+@app.route("/profiles")
+def list_profiles():
+    count("profiles")
+    error = simulate("nextdns")
+    if error is not None:
+        return error
+    key = request.headers.get("X-Api-Key")
+    data = [{"id": pid, "name": pid} for pid, p in profiles.items() if p.api_key == key]
+    if not data:
+        return jsonify({"errors": [{"code": "forbidden"}]}), 403
+    return jsonify({"data": data})
+
+
+@app.route("/profiles/<profile_id>/denylist")
+def denylist(profile_id):
+    count("denylist")
+    error = simulate("nextdns")
+    if error is not None:
+        return error
+    profile, failure = authorized_profile(profile_id)
+    if failure:
+        return failure
+    if request.headers.get("If-None-Match") == profile.denylist_etag:
+        count("denylist_304")
+        return Response(status=304, headers={"ETag": profile.denylist_etag})
+    return Response(profile.denylist_body, mimetype="application/json", headers={"ETag": profile.denylist_etag})
+
+
+@app.route("/profiles/<profile_id>/logs")
+def logs(profile_id):
+    count("logs")
+    error = simulate("nextdns")
+    if error is not None:
+        return error
+    profile, failure = authorized_profile(profile_id)
+    if failure:
+        return failure
+    try:
+        limit = max(1, min(config.page_size, int(request.args.get("limit", config.page_size))))
+        page = profile.page(parse_from(request.args.get("from")), request.args.get("sort") == "asc", limit,
+                            request.args.get("cursor"))
+    except ValueError:
+        return jsonify({"errors": [{"code": "invalid"}]}), 400
+    count("log_lines", len(page["data"]))
+    return jsonify(page)
+
+
+@app.route("/profiles/<profile_id>/logs/stream")
+def logs_stream(profile_id):
+    count("streams")
+    error = simulate("nextdns")
+    if error is not None:
+        return error
+    profile, failure = authorized_profile(profile_id)
+    if failure:
+        return failure
+    resume = request.args.get("id") or request.headers.get("Last-Event-ID")
+    try:
+        after = int(resume) if resume else profile.seq
+    except ValueError:
+        return jsonify({"errors": [{"code": "invalid"}]}), 400
+
+    def events(after):
+        opened = last_sent = time.time()
+        while not config.stream_drop or time.time() - opened < config.stream_drop:
+            lines = profile.since(after)
+            for seq, entry in lines:
+                yield "id: {}\ndata: {}\n\n".format(seq, json.dumps(entry))
+                after = seq
+            count("stream_lines", len(lines))
+            if lines:
+                last_sent = time.time()
+            elif time.time() - last_sent >= config.stream_keepalive:
+                yield ": keepalive\n\n"
+                last_sent = time.time()
+            time.sleep(0.1)
+
+    return Response(events(after), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+# -------------------- Telegram endpoint --------------------
+@app.route("/bot<token>/sendMessage", methods=["POST"])
+def send_message(token):
+    count("telegram")
+    error = simulate("telegram")
+    if error is not None:
+        return error
+    payload = request.get_json(silent=True) or request.form
+    if not payload.get("chat_id") or not payload.get("text"):
+        return jsonify({"ok": False, "error_code": 400, "description": "Bad Request: message text is empty"}), 400
+    count("telegram_messages")
+    with stats_lock:
+        message_id = stats["telegram_messages"]
+    return jsonify({"ok": True, "result": {"message_id": message_id, "date": int(time.time())}})
+
+
+@app.route("/stats")
+def get_stats():
+    with stats_lock:
+        return jsonify(dict(stats, profiles=len(profiles)))
+
+
+# -------------------- CLI --------------------
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fake NextDNS + Telegram API for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--profiles", type=int, default=100, help="synthetic profiles to serve")
+    parser.add_argument("--keys", type=int, default=1, help="API keys the profiles are spread across")
+    parser.add_argument("--log-rate", type=float, default=2.0, help="log lines per second per profile")
+    parser.add_argument("--backlog", type=float, default=60, help="seconds of logs present at startup")
+    parser.add_argument("--retention", type=float, default=600, help="seconds of logs kept per profile")
+    parser.add_argument("--page-size", type=int, default=1000, help="max entries per /logs page")
+    parser.add_argument("--denylist-size", type=int, default=100)
+    parser.add_argument("--block-ratio", type=float, default=0.2, help="share of other lines that are blocked")
+    parser.add_argument("--match-ratio", type=float, default=0.01, help="share of lines hitting the denylist")
+    parser.add_argument("--latency", type=float, default=0, help="mean response latency in ms")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0, help="share of requests answered with 429")
+    parser.add_argument("--error-ratio", type=float, default=0, help="share of NextDNS requests answered with 503")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--stream-keepalive", type=float, default=15, help="seconds between idle stream keep-alives")
+    parser.add_argument("--stream-drop", type=float, default=0, help="close log streams after this many seconds (0: never)")
+    parser.add_argument("--write-accounts", metavar="FILE", help="write an accounts file for the fake profiles and exit")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    global config
+    config = parse_args(argv)
+    build_profiles()
+    if config.write_accounts:
+        with open(config.write_accounts, "w", encoding="utf-8") as f:
+            json.dump(accounts_file_data(), f, indent=4, ensure_ascii=False)
+        print("Wrote {} accounts to {}".format(len(profiles), config.write_accounts))
+        return
+    print("Fake NextDNS/Telegram API on http://{}:{} ({} profiles, {} keys)".format(
+        config.host, config.port, len(profiles), config.keys))
+    app.run(host=config.host, port=config.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
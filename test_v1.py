@@ -0,0 +1,158 @@
+import json
+
+import v1
+
+
+def write_json(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+
+def profile_state(*profile_ids):
+    return {
+        "processed_requests": {pid: [[1, 1.0]] for pid in profile_ids},
+        "log_cursors": {pid: {"last_ts": "2024-01-01T00:00:00.000Z", "last_keys": []} for pid in profile_ids},
+        "denylist_cache": {pid: ["example.com"] for pid in profile_ids},
+    }
+
+
+def test_deleted_profile_stays_deleted_after_reload(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    account = {"name": "A", "api_key": "k", "active": True}
+    write_json(v1.ACCOUNTS_FILE, {"pa": account, "pb": dict(account, name="B")})
+    write_json(v1.STATE_FILE, profile_state("pa", "pb"))
+    # left behind by an earlier sharded run
+    write_json("state.shard0.json", profile_state("pa"))
+
+    manager = v1.NextDNSManager()
+    assert "pa" in manager.log_cursors
+    manager.forget_profile_state("pa")
+    del manager.accounts["pa"]
+    manager.save_accounts()
+    manager.save_state()
+    manager.alert_history.close()
+
+    manager = v1.NextDNSManager()
+    assert "pa" not in manager.log_cursors and "pb" in manager.log_cursors
+    manager.alert_history.close()
+
+    # added again, the profile must start fresh rather than from the stale shard file
+    write_json(v1.ACCOUNTS_FILE, {"pa": account, "pb": dict(account, name="B")})
+    manager = v1.NextDNSManager()
+    for section in v1.STATE_PROFILE_SECTIONS:
+        assert "pa" not in manager.state[section]
+    manager.alert_history.close()
+
+
+def test_shard_loads_only_its_own_profiles(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ring = v1.ShardRing(2)
+    pids = ["p{}".format(i) for i in range(20)]
+    write_json(v1.ACCOUNTS_FILE, {pid: {"name": pid, "api_key": "k", "active": True} for pid in pids})
+    write_json(v1.STATE_FILE, profile_state(*pids))
+
+    manager = v1.NextDNSManager(shard=(0, 2))
+    assert set(manager.log_cursors) == {pid for pid in pids if ring.shard_for(pid) == 0}
+    assert manager.state_store.dirty
+    manager.alert_history.close()
+
+
+def test_alert_history_recovers_from_a_failed_batch(tmp_path):
+    history = v1.AlertHistory(str(tmp_path / "alerts.db"))
+    history.db.execute("CREATE TEMP TRIGGER fail BEFORE INSERT ON alerts BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+    for i in range(3):
+        history.add(v1.AlertEvent("A", "x{}.example.com".format(i), "10.0.0.1", "phone", "pa", 1700000000000 + i))
+    try:
+        history.flush()
+    except v1.sqlite3.Error:
+        pass
+    assert len(history.pending) == 3 and not history.db.in_transaction
+
+    history.db.execute("DROP TRIGGER fail")
+    assert history.flush() == 3
+    assert [row["domain"] for row in history.query()] == ["x2.example.com", "x1.example.com", "x0.example.com"]
+    history.close()
+
+
+def test_alert_history_endpoint_is_private(monkeypatch):
+    client = v1.app.test_client()
+    assert client.get("/alerts", environ_base={"REMOTE_ADDR": "203.0.113.5"}).status_code == 401
+    assert client.get("/alerts").status_code == 200  # the test client is 127.0.0.1
+
+    monkeypatch.setattr(v1, "MONITOR_API_TOKEN", "s3cret")
+    assert client.get("/alerts").status_code == 401
+    assert client.get("/alerts", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert client.get("/alerts", headers={"Authorization": "Bearer s3cret"},
+                      environ_base={"REMOTE_ADDR": "203.0.113.5"}).status_code == 200
+
+
+def test_alert_dispatcher_defers_during_telegram_outage():
+    dispatcher = v1.AlertDispatcher(window=0)
+    for i in range(30):
+        dispatcher.submit("A", "x{}.example.com".format(i), "denylist", "10.0.0.1")
+    sends = []
+
+    def down(text, markdown):
+        sends.append(text)
+        return 503, 0
+
+    assert dispatcher.flush(down) == 0
+    assert len(sends) == 1 and len(dispatcher.pending) == 30 and dispatcher.failed == 0
+    assert dispatcher.paused_until > v1.time.time()
+
+    sends.clear()
+    dispatcher.paused_until = 0
+    assert dispatcher.flush(lambda text, markdown: (sends.append(markdown) or (400 if markdown else 200), 0)) == 30
+    assert sends.count(False) == 30 and not dispatcher.pending
+
+
+def test_alert_dispatcher_sends_first_hit_at_once_and_coalesces_repeats():
+    dispatcher = v1.AlertDispatcher(window=60)
+    dispatcher.submit("A", "bad.example.com", "denylist", "10.0.0.1")
+    dispatcher.submit("A", "bad.example.com", "denylist", "10.0.0.1")
+    first = dispatcher.take_due()
+    assert [alert["hits"] for alert in first] == [2]
+
+    dispatcher.submit("A", "bad.example.com", "denylist", "10.0.0.1")
+    dispatcher.submit("A", "bad.example.com", "denylist", "10.0.0.1")
+    assert dispatcher.take_due() == []
+    assert [alert["hits"] for alert in dispatcher.take_due(force=True)] == [2]
+
+
+def test_trace_sampling_needs_a_private_post(monkeypatch):
+    requested = []
+
+    class Manager:
+        def request_trace_sample(self, profile_id, polls=None):
+            requested.append(profile_id)
+            return True
+
+        def trace_report(self):
+            return {}
+
+    monkeypatch.setattr(v1, "manager", Manager())
+    client = v1.app.test_client()
+    assert client.get("/trace?sample=pa").status_code == 200 and requested == []
+    assert client.post("/trace?sample=pa", environ_base={"REMOTE_ADDR": "203.0.113.5"}).status_code == 401
+    assert client.post("/trace?sample=pa").status_code == 200 and requested == ["pa"]
+
+
+def test_shard_restarts_back_off_while_a_shard_keeps_crashing():
+    supervisor = v1.ShardSupervisor(1, {})
+    started = []
+
+    def start_shard(index):
+        started.append(index)
+        supervisor.started_at[index] = v1.time.time()
+
+    supervisor.start_shard = start_shard
+    supervisor.started_at[0] = v1.time.time()
+    dead = type("Process", (), {"exitcode": 1})()
+    delays = []
+    for _ in range(4):
+        supervisor.check_shard(0, dead)
+        delays.append(round(supervisor.restart_at[0] - v1.time.time()))
+        supervisor.check_shard(0, dead)  # not due yet
+        supervisor.restart_at[0] = 0
+        supervisor.check_shard(0, dead)
+    assert delays == [1, 2, 4, 8] and started == [0] * 4 and supervisor.restarts[0] == 4
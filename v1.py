@@ -1,17 +1,86 @@
-from flask import Flask
-import threading, time
+from flask import Flask, Response, jsonify, request
+import functools, hmac, threading, time
 
 app = Flask('')
+manager = None  # set by main(); the status endpoints read from it
+
+def private(view):
+    # alert history and profiling: MONITOR_API_TOKEN as a bearer token, or localhost only when it is unset
+    @functools.wraps(view)
+    def guarded(*args, **kwargs):
+        if MONITOR_API_TOKEN:
+            token = request.headers.get('Authorization', '').partition('Bearer ')[2]
+            allowed = hmac.compare_digest(token.encode(), MONITOR_API_TOKEN.encode())
+        else:
+            allowed = request.remote_addr in ('127.0.0.1', '::1')
+        if not allowed:
+            return jsonify({"error": "unauthorized"}), 401
+        return view(*args, **kwargs)
+    return guarded
 
 @app.route('/')
 def home():
     return "البوت شغال ✅"
 
+@app.route('/metrics')
+def metrics():
+    body = manager.render_metrics() if manager else ""
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+@app.route('/status')
+def status():
+    return jsonify(manager.status() if manager else {"monitoring": False, "workers": {}})
+
+@app.route('/analytics')
+@app.route('/analytics/<profile_id>')
+def analytics(profile_id=None):
+    if manager is None:
+        return jsonify({})
+    window = request.args.get('window', '1h')
+    if window not in ANALYTICS_WINDOWS:
+        return jsonify({"error": "window must be one of " + ", ".join(ANALYTICS_WINDOWS)}), 400
+    report = manager.analytics_report(window, request.args.get('top', TOP_K_SHOWN, type=int), profile_id)
+    if profile_id is not None and report is None:
+        return jsonify({"error": "no traffic seen for this profile"}), 404
+    return jsonify(report)
+
+@app.route('/alerts')
+@private
+def alerts():
+    # e.g. /alerts?domain=example.com&subdomains=1&since=7d&by=client_ip
+    if manager is None:
+        return jsonify([])
+    args = request.args
+    try:
+        rows = manager.query_alert_history(
+            profile_id=args.get('profile'), domain=args.get('domain'), subdomains=args.get('subdomains') in ('1', 'true'),
+            client_ip=args.get('client'), since=parse_since(args['since']) if args.get('since') else None,
+            until=parse_since(args['until']) if args.get('until') else None, group_by=args.get('by'),
+            limit=args.get('limit', 100, type=int))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(rows)
+
+@app.route('/trace', methods=['GET', 'POST'])
+@private
+def trace():
+    # POST /trace?sample=<profile_id>&polls=N starts a cProfile / tracemalloc sample of that profile
+    if manager is None:
+        return jsonify({})
+    if request.method == 'POST':
+        if not request.args.get('sample'):
+            return jsonify({"error": "sample=<profile_id> is required"}), 400
+        if not manager.request_trace_sample(request.args['sample'], request.args.get('polls', type=int)):
+            return jsonify({"error": "profile is not monitored by this process"}), 404
+    return jsonify(manager.trace_report())
+
 def run():
     app.run(host='0.0.0.0', port=8080)
 
-t = threading.Thread(target=run)
-t.start()
+def start_web_server():
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    return t
 
 
 #!/usr/bin/env python3
@@ -22,47 +91,1830 @@ Enhanced with better UI and persistent data
 """
 
 import os
+import re
 import json
+import codecs
 import time
+import cProfile
+import pstats
+import tracemalloc
+import contextlib
+import queue
+import hashlib
+import sqlite3
+import signal
+import asyncio
+import bisect
+import heapq
+import random
+import glob
+import argparse
+import multiprocessing
 import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, Set, Any
+from email.utils import parsedate_to_datetime
+from typing import Dict, Set, Any, NamedTuple
 import sys
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+
+try:
+    import aiohttp  # optional, only needed for --engine=async
+except ImportError:
+    aiohttp = None
+
+try:
+    import orjson  # optional, faster decoding of whole JSON bodies
+except ImportError:
+    orjson = None
 
 # Files
 ACCOUNTS_FILE = "nextdns_accounts.json"
 BOT_SETTINGS_FILE = "bot_settings.json"
 STATE_FILE = "state.json"
+STATE_DB_FILE = "state.db"
+ALERT_HISTORY_FILE = "alerts.db"
+STATE_BACKENDS = ("json", "sqlite")
+
+# API endpoints; override to point the manager at fake_nextdns.py for load tests
+NEXTDNS_API_BASE = os.environ.get("NEXTDNS_API_BASE", "https://api.nextdns.io").rstrip("/")
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+# bearer token for the private web endpoints (/alerts, /trace); without one they only answer localhost
+MONITOR_API_TOKEN = os.environ.get("MONITOR_API_TOKEN", "")
 
 # Network timeouts
 HTTP_TIMEOUT = 10
 
+# NextDNS API retries and circuit breaking
+API_MAX_RETRIES = 3            # extra attempts after a 429 / 5xx / connection error
+API_BACKOFF_BASE = 0.5         # first backoff step in seconds, doubled per attempt (full jitter)
+API_BACKOFF_MAX = 30           # longer waits (incl. Retry-After) are left to the circuit breaker
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+BREAKER_FAILURE_THRESHOLD = 3  # consecutive failed calls before a profile's breaker opens
+BREAKER_RESET_SECONDS = 60     # first open period; doubles while probes keep failing
+BREAKER_MAX_SECONDS = 900
+
+# Connection pools
+HTTP_POOL_MIN_SIZE = 4         # keep-alive connections per host, even with few workers
+HTTP_POOL_MAX_SIZE = 100       # per-host cap, however many workers are running
+
+# Log ingestion
+LOG_PAGE_LIMIT = 1000          # max entries per /logs page allowed by the API
+MAX_LOG_PAGES_PER_POLL = 50    # remaining pages are drained on the next poll
+LOG_STREAM_CHUNK_SIZE = 64 * 1024  # /logs bodies are parsed incrementally in chunks of this size
+
+# Streaming ingestion (--engine stream)
+STREAM_READ_TIMEOUT = 90       # reconnect when the SSE stream is silent (no events or keep-alives) this long
+STREAM_COMMIT_SECONDS = 5      # how often a stream persists its cursor / resume id
+STREAM_RECONNECT_SECONDS = 5   # minimum time between connections when the server keeps closing the stream
+STREAM_MAX_FAILURES = 3        # consecutive stream failures before falling back to polling
+STREAM_RETRY_SECONDS = 300     # how long to poll before trying the stream again
+
+# Monitoring
+MONITOR_ENGINES = ("thread", "async", "stream")
+CHECK_INTERVAL = 10            # starting poll interval; adapted per profile from its traffic
+MIN_POLL_INTERVAL = 2          # busy profiles / full pages poll this often at most
+MAX_POLL_INTERVAL = 120        # idle profiles back off to this
+BUSY_LOGS_PER_POLL = 100       # more new log lines than this in one poll counts as busy
+SCHEDULER_MAX_WORKERS = 32     # poll threads shared by all profiles in the thread engine
+API_REQUESTS_PER_SECOND = 20   # global NextDNS request budget across all API keys (0 = unlimited)
+API_KEY_REQUESTS_PER_SECOND = 5  # budget shared by all profiles behind one API key (0 = unlimited)
+STATE_SAVE_INTERVAL = 60       # seconds between periodic state saves while monitoring
+STATE_PROFILE_SECTIONS = ("processed_requests", "log_cursors", "denylist_cache")  # keyed by profile id
+DENYLIST_REFRESH_SECONDS = 300  # default; override per account with "denylist_refresh_seconds"
+ASYNC_MAX_CONCURRENCY = 50     # in-flight API requests for the async engine
+
+# Telegram alerts
+ALERT_COALESCE_WINDOW = 10     # first hit goes out at once; repeats within this many seconds become one follow-up
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+ALERT_QUEUE_SIZE = 1000        # alerts waiting for the sender pool
+ALERT_SENDERS = 2              # threads delivering alerts to Telegram
+ALERT_OVERFLOW_POLICIES = ("drop-oldest", "block", "spill")
+ALERT_SPILL_FILE = "alerts_spill.jsonl"
+ALERT_RETRY_BASE = 5           # first pause after Telegram is unreachable / 5xx, doubled per failed flush
+ALERT_RETRY_MAX = 300
+
+# Dashboard
+DASHBOARD_SNAPSHOT_TTL = 30    # seconds before a profile's dashboard stats are re-fetched
+DASHBOARD_FETCH_WORKERS = 8    # concurrent profile fetches for the dashboard
+RECENT_BLOCKS_WINDOW = 60      # "Recent blocks" covers the last minute
+
+# Alert history (alerts.db)
+ALERT_HISTORY_RETENTION_DAYS = 90  # older alerts are deleted by compaction (0 = keep forever)
+ALERT_HISTORY_BATCH = 500          # rows per insert transaction
+ALERT_HISTORY_FLUSH_SECONDS = 2    # longest an alert waits before it is written
+ALERT_HISTORY_QUEUE_SIZE = 50000   # alerts waiting for the writer; more are dropped and counted
+ALERT_HISTORY_COMPACT_SECONDS = 3600
+ALERT_HISTORY_GROUPS = ("profile_id", "domain", "client_ip", "device")
+ALERT_HISTORY_MAX_ROWS = 10000     # most rows one history query returns
+
+# Blocked-traffic analytics, aggregated from ingested logs
+ANALYTICS_WINDOWS = {"1h": 3600, "24h": 86400}
+TOP_K_CAPACITY = 50            # space-saving counters per profile, dimension and hour
+TOP_K_SHOWN = 10               # default entries returned by /analytics
+
+# Prometheus metric descriptions
+METRIC_HELP = {
+    "nextdns_poll_duration_seconds": "Time to fetch and process one log poll",
+    "nextdns_logs_ingested_total": "Log entries ingested",
+    "nextdns_matches_total": "Blocked log entries matching the custom denylist",
+    "nextdns_poll_errors_total": "Polls that failed",
+    "nextdns_api_retries_total": "NextDNS API calls retried after a 429, 5xx or connection error",
+    "nextdns_circuit_opens_total": "Times a profile's circuit breaker opened",
+    "nextdns_circuit_open": "1 while the profile's circuit breaker rejects API calls",
+    "nextdns_alerts_sent_total": "Alerts delivered to Telegram",
+    "nextdns_alerts_failed_total": "Alerts Telegram rejected",
+    "nextdns_alerts_coalesced_total": "Repeated hits folded into an earlier alert",
+    "nextdns_alerts_dropped_total": "Alerts dropped because the queue was full",
+    "nextdns_alerts_spilled_total": "Alerts spilled to disk because the queue was full",
+    "nextdns_alert_queue_depth": "Alerts waiting for the sender pool",
+    "nextdns_alerts_pending": "Coalesced alerts waiting for their window to close",
+    "nextdns_dedupe_entries": "Request ids held in the dedupe cache",
+    "nextdns_denylist_entries": "Entries in the profile's custom denylist",
+    "nextdns_worker_up": "1 if the profile's monitor worker is polling",
+    "nextdns_last_successful_poll_timestamp_seconds": "Unix time of the last successful poll",
+    "nextdns_alert_history_written_total": "Alerts written to the alert history database",
+    "nextdns_alert_history_dropped_total": "Alerts not recorded because the history writer fell behind",
+    "nextdns_shard_up": "1 if the shard process is alive",
+    "nextdns_shard_restarts_total": "Times the supervisor restarted a dead shard",
+}
+
+# Tracing (--trace / --trace-sample)
+TRACE_FILE = "trace.json"      # stage timings and finished samples are dumped here
+TRACE_SAMPLE_POLLS = 20        # polls (stream engine: events) profiled per sample by default
+TRACE_TOP_ENTRIES = 25         # functions / allocation sites kept per sample
+TRACE_SAMPLES_KEPT = 5         # finished samples kept for /trace
+
+# Sharding
+SHARD_VNODES = 64              # virtual nodes per shard on the hash ring
+SHARD_REPORT_INTERVAL = 5      # seconds between shard -> supervisor metric reports
+SHARD_RESTART_BASE = 1         # first wait before restarting a dead shard, doubled per crash in a row
+SHARD_RESTART_MAX = 300
+SHARD_STABLE_SECONDS = 60      # a shard that ran this long starts its crash count over
+
+# Alert dedupe
+DEDUPE_TTL_SECONDS = 3600      # how long an alerted request id is remembered
+DEDUPE_MAX_ENTRIES = 10000     # per-profile cap, oldest ids are evicted first
+
+
+class DenylistMatcher:
+    """
+    Compiled denylist built once per refresh.
+    Entries are stored in a trie keyed by reversed labels (com -> example -> ads),
+    so a lookup walks the domain's labels once instead of scanning every entry.
+    Plain entries and *. wildcards both match the domain itself and any subdomain.
+    The matcher can be patched in place with update() when the denylist changes.
+    """
+
+    _TERMINAL = ""  # لا يوجد label فارغ في أسماء النطاقات، لذلك نستخدمه كعلامة نهاية
+
+    def __init__(self, entries=()):
+        self.root: Dict[str, Any] = {}
+        self.entries: Set[str] = set()
+        # version of the API response this matcher was built from
+        self.etag: str = None
+        self.source_hash: str = None
+        for entry in entries:
+            self.add(entry)
+
+    @staticmethod
+    def _labels(entry: str) -> list:
+        entry = entry.lower().strip()
+        if entry.startswith("*."):
+            entry = entry[2:]
+        return [label for label in reversed(entry.split(".")) if label]
+
+    def add(self, entry: str) -> bool:
+        labels = self._labels(entry)
+        if not labels or entry in self.entries:
+            return False
+        node = self.root
+        for label in labels:
+            node = node.setdefault(label, {})
+        # "a.com" and "*.a.com" share a node, so count the entries ending here
+        node[self._TERMINAL] = node.get(self._TERMINAL, 0) + 1
+        self.entries.add(entry)
+        return True
+
+    def remove(self, entry: str) -> bool:
+        if entry not in self.entries:
+            return False
+        path = [self.root]
+        for label in self._labels(entry):
+            path.append(path[-1][label])
+        node = path[-1]
+        node[self._TERMINAL] -= 1
+        if not node[self._TERMINAL]:
+            del node[self._TERMINAL]
+        # prune branches left empty
+        for label, parent in zip(reversed(self._labels(entry)), reversed(path[:-1])):
+            if parent[label]:
+                break
+            del parent[label]
+        self.entries.discard(entry)
+        return True
+
+    def update(self, entries) -> tuple:
+        """Apply only the difference to a new denylist; returns (added, removed) counts."""
+        new_entries = set(entries)
+        removed = self.entries - new_entries
+        added = new_entries - self.entries
+        for entry in removed:
+            self.remove(entry)
+        for entry in added:
+            self.add(entry)
+        return len(added), len(removed)
+
+    def matches(self, domain: str) -> bool:
+        node = self.root
+        for label in reversed(domain.split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if self._TERMINAL in node:
+                return True
+        return False
+
+    def match_many(self, domains) -> list:
+        """
+        Match a whole log page at once.
+        Each distinct name is normalized and looked up only once, then the result is
+        fanned back out, so repeated hostnames on a page cost a dict hit.
+        """
+        results: Dict[str, bool] = {}
+        out = []
+        for domain in domains:
+            hit = results.get(domain)
+            if hit is None:
+                hit = results[domain] = bool(domain) and self.matches(domain.lower().strip())
+            out.append(hit)
+        return out
+
+    def __contains__(self, domain: str) -> bool:
+        return self.matches(domain.lower().strip())
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class Metrics:
+    """
+    Minimal in-process Prometheus registry: labelled counters and histograms.
+    Gauges are read from live objects at scrape time, see NextDNSManager.render_metrics.
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
 
-class NextDNSManager:
     def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[tuple, float] = {}
+        self.histograms: Dict[tuple, list] = {}
+        self.help: Dict[str, str] = dict(METRIC_HELP)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                # bucket counts..., sum, count
+                hist = self.histograms[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def export(self) -> Dict[str, list]:
+        """Picklable copy of all samples, for shipping to the shard supervisor."""
+        with self.lock:
+            return {
+                "counters": [(name, labels, value) for (name, labels), value in self.counters.items()],
+                "histograms": [(name, labels, list(hist)) for (name, labels), hist in self.histograms.items()],
+            }
+
+    def absorb(self, exported: Dict[str, list], **extra_labels):
+        """Add another registry's exported samples into this one."""
+        extra = tuple(extra_labels.items())
+        with self.lock:
+            for name, labels, value in exported["counters"]:
+                key = (name, tuple(sorted(labels + extra)))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, hist in exported["histograms"]:
+                key = (name, tuple(sorted(labels + extra)))
+                mine = self.histograms.setdefault(key, [0] * len(self.BUCKETS) + [0.0, 0])
+                for i, value in enumerate(hist):
+                    mine[i] += value
+
+    @staticmethod
+    def format_labels(labels) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+    def render(self, gauges: list = ()) -> str:
+        """gauges: (name, labels dict, value) tuples sampled by the caller."""
+        samples: Dict[str, list] = {}
+        kinds: Dict[str, str] = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                kinds[name] = "counter"
+                samples.setdefault(name, []).append(f"{name}{self.format_labels(labels)} {value}")
+            for (name, labels), hist in self.histograms.items():
+                kinds[name] = "histogram"
+                lines = samples.setdefault(name, [])
+                for bound, count in zip(self.BUCKETS, hist):
+                    lines.append(f"{name}_bucket{self.format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{self.format_labels(labels + (('le', '+Inf'),))} {hist[-1]}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {hist[-2]}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {hist[-1]}")
+        for name, labels, value in gauges:
+            kinds.setdefault(name, "counter" if name.endswith("_total") else "gauge")
+            samples.setdefault(name, []).append(f"{name}{self.format_labels(tuple(sorted(labels.items())))} {value}")
+        out = []
+        for name, lines in samples.items():
+            out.append(f"# HELP {name} {self.help.get(name, name)}")
+            out.append(f"# TYPE {name} {kinds[name]}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+
+class StageSpan:
+    """Times one stage of a poll into the tracer, see Tracer.span."""
+
+    __slots__ = ("tracer", "stage", "started")
+
+    def __init__(self, tracer: "Tracer", stage: str):
+        self.tracer = tracer
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.stage, time.perf_counter() - self.started)
+
+
+NULL_SPAN = contextlib.nullcontext()
+
+
+class Tracer:
+    """
+    Opt-in instrumentation of the monitoring pipeline: per-stage timing spans
+    (fetch, decode, match, dedupe, denylist, send, save_state) and on-demand
+    cProfile + tracemalloc samples of a number of one profile's polls.
+    While off, span() and sampling() hand back a shared no-op context manager,
+    so the hooks stay in the hot path at the cost of an attribute check.
+    """
+
+    def __init__(self, enabled: bool = False, path: str = TRACE_FILE):
+        self.enabled = enabled
+        self.path = path
+        self.lock = threading.Lock()
+        self.stages: Dict[str, list] = {}  # stage -> [count, total seconds, max seconds]
+        # the one sample in progress: profile id, polls left, profiler and when it started
+        self.sample_profile: str = None
+        self.sample_left = 0
+        self.sample_polls = 0
+        self.profiler: cProfile.Profile = None
+        self.sample_started = 0.0
+        self.owns_tracemalloc = False
+        self.samples: deque = deque(maxlen=TRACE_SAMPLES_KEPT)
+
+    def span(self, stage: str):
+        return StageSpan(self, stage) if self.enabled else NULL_SPAN
+
+    def record(self, stage: str, seconds: float):
+        with self.lock:
+            totals = self.stages.get(stage)
+            if totals is None:
+                totals = self.stages[stage] = [0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += seconds
+            if seconds > totals[2]:
+                totals[2] = seconds
+
+    def request_sample(self, profile_id: str, polls: int = TRACE_SAMPLE_POLLS) -> bool:
+        """Profile the next `polls` polls of one profile; False while another sample is running."""
+        with self.lock:
+            if self.profiler is not None:
+                return False
+            self.sample_profile, self.sample_left, self.sample_polls = profile_id, max(1, polls), 0
+            return True
+
+    def sampling(self, profile_id: str):
+        """Context for one poll of profile_id: profiled when a sample of it is pending."""
+        if profile_id != self.sample_profile:
+            return NULL_SPAN
+        return self.sample_poll()
+
+    @contextlib.contextmanager
+    def sample_poll(self):
+        with self.lock:
+            if self.sample_profile is not None and self.profiler is None:
+                self.profiler = cProfile.Profile()
+                self.sample_started = time.time()
+                self.owns_tracemalloc = not tracemalloc.is_tracing()
+                if self.owns_tracemalloc:
+                    tracemalloc.start()
+            profiler = self.profiler
+        if profiler is None:
+            # the sample finished during a concurrent poll
+            yield
+            return
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # another profiler (e.g. a debugger) holds the hook
+            self.finish_sample(error=str(e))
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self.lock:
+                self.sample_polls += 1
+                self.sample_left -= 1
+                done = self.sample_left <= 0
+            if done:
+                self.finish_sample()
+
+    def finish_sample(self, error: str = None):
+        with self.lock:
+            profiler, self.profiler = self.profiler, None
+            report = {
+                "profile": self.sample_profile,
+                "polls": self.sample_polls,
+                "started_at": self.sample_started,
+                "finished_at": time.time(),
+            }
+            self.sample_profile, self.sample_left = None, 0
+        if error:
+            report["error"] = error
+        else:
+            stats = pstats.Stats(profiler).stats
+            top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:TRACE_TOP_ENTRIES]
+            report["functions"] = [
+                {"function": "{}:{}({})".format(*func), "calls": nc, "self_seconds": round(tt, 6),
+                 "cumulative_seconds": round(ct, 6)}
+                for func, (cc, nc, tt, ct, callers) in top
+            ]
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            report["peak_kb"] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+            report["allocations"] = [
+                {"site": str(stat.traceback[0]), "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:TRACE_TOP_ENTRIES]
+            ]
+            if self.owns_tracemalloc:
+                tracemalloc.stop()
+        self.samples.append(report)
+        self.dump()
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            stages = {
+                stage: {"count": count, "total_seconds": round(total, 6),
+                        "mean_ms": round(total / count * 1000, 3) if count else 0.0, "max_ms": round(peak * 1000, 3)}
+                for stage, (count, total, peak) in sorted(self.stages.items())
+            }
+            sampling = {"profile": self.sample_profile, "polls_left": self.sample_left} if self.sample_profile else None
+            return {"enabled": self.enabled, "stages": stages, "sampling": sampling, "samples": list(self.samples)}
+
+    def dump(self):
+        try:
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(self.report(), f, indent=2)
+        except OSError as e:
+            print(f"⚠️  Could not write trace to {self.path}: {e}")
+
+
+class RateBudget:
+    """Token bucket shared by every NextDNS request, whatever the API key."""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take one token; returns how long the caller must wait before using it."""
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+class NextDNSAPIError(Exception):
+    """A NextDNS call that still failed after retries (or was refused by an open breaker)."""
+
+    def __init__(self, message: str, status: int = None, retry_after: float = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(NextDNSAPIError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Per-profile breaker around NextDNS calls. After BREAKER_FAILURE_THRESHOLD consecutive
+    failed calls it rejects calls until the open period passes, then lets a probe through.
+    A failure carrying the server's Retry-After opens it for that long straight away.
+    """
+
+    def __init__(self, threshold: int = BREAKER_FAILURE_THRESHOLD, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_until = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.retry_in() > 0:
+            return "open"
+        return "half-open" if self.failures >= self.threshold else "closed"
+
+    def retry_in(self) -> float:
+        return max(0.0, self.opened_until - time.time())
+
+    def allow(self) -> bool:
+        return self.retry_in() == 0
+
+    def success(self) -> bool:
+        """Close the breaker; returns True if it had been tripped."""
+        with self.lock:
+            tripped = self.failures >= self.threshold
+            self.failures = 0
+            self.opened_until = 0.0
+            return tripped
+
+    def failure(self, retry_after: float = None) -> float:
+        """Count a failed call; returns the open period if this failure (re)opened the breaker, else 0."""
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.threshold:
+                if not retry_after:
+                    return 0.0
+                # the server said when to come back; don't poll it again before then
+                period = retry_after
+            else:
+                period = min(BREAKER_MAX_SECONDS, self.reset_seconds * 2 ** (self.failures - self.threshold))
+                period = max(period, retry_after or 0)
+            self.opened_until = max(self.opened_until, time.time() + period)
+            return period
+
+
+def parse_retry_after(value: str) -> float:
+    """Retry-After as seconds; the header may carry either a delay or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: float = None) -> float:
+    """Delay before retry number attempt+1: the server's Retry-After, else full-jitter exponential."""
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt))
+
+
+def is_read_timeout(error: Exception) -> bool:
+    """True for a read timeout, including the ConnectionError iter_lines wraps one in mid-stream."""
+    return isinstance(error, requests.ReadTimeout) or (
+        isinstance(error, requests.ConnectionError) and bool(error.args)
+        and isinstance(error.args[0], ReadTimeoutError))
+
+
+class PollScheduler:
+    """
+    Central poll scheduler for the thread engine.
+    Profiles wait in a priority queue keyed by their next due time; a bounded pool
+    runs due polls, and each poll returns the delay until its next one (None stops it).
+    """
+
+    def __init__(self, poll, workers: int, stop_event: threading.Event):
+        self.poll = poll
+        self.stop_event = stop_event
+        self.heap: list = []
+        self.cond = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="poll")
+        self.thread: threading.Thread = None
+
+    def schedule(self, profile_id: str, delay: float = 0):
+        with self.cond:
+            heapq.heappush(self.heap, (time.time() + delay, profile_id))
+            self.cond.notify()
+
+    def run_poll(self, profile_id: str):
+        delay = self.poll(profile_id)
+        if delay is not None and not self.stop_event.is_set():
+            self.schedule(profile_id, delay)
+
+    def loop(self):
+        while not self.stop_event.is_set():
+            with self.cond:
+                if not self.heap:
+                    self.cond.wait(1)
+                    continue
+                due, profile_id = self.heap[0]
+                wait = due - time.time()
+                if wait > 0:
+                    self.cond.wait(min(wait, 1))
+                    continue
+                heapq.heappop(self.heap)
+            self.pool.submit(self.run_poll, profile_id)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, name="poll-scheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join(timeout=2)
+        self.pool.shutdown(wait=True)
+
+
+class AlertEvent(NamedTuple):
+    """One new custom-denylist block on its way from a poll loop to the dispatcher."""
+    account_name: str
+    domain: str
+    client_ip: str = ""
+    device: str = ""
+    profile_id: str = ""
+    timestamp: int = 0  # log time, unix ms
+
+    @property
+    def reason(self) -> str:
+        if self.device:
+            return "Blocked by custom denylist (Device: {})".format(self.device)
+        return "Blocked by custom denylist"
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "AlertEvent":
+        """Rebuild a spilled alert; older spill files carried the device inside "reason"."""
+        device = data.get("device")
+        if device is None:
+            reason = data.get("reason") or ""
+            device = reason.partition("(Device: ")[2].rstrip(")")
+        return cls(data.get("account_name") or "Account", data.get("domain", ""), data.get("client_ip") or "", device,
+                   data.get("profile_id") or "", data.get("timestamp") or 0)
+
+
+def escape_markdown(text: str) -> str:
+    """Escape Telegram (legacy) Markdown so names like DESKTOP_AB12 don't break the message."""
+    return re.sub(r"([_*`\[])", r"\\\1", str(text))
+
+
+class AlertDispatcher:
+    """
+    Sits between the monitor loops and Telegram.
+    The first hit of an (account, domain, client) is due at once; repeats inside the
+    coalescing window after it become one follow-up alert with a hit count. Due alerts are packed into as few messages as Telegram
+    allows, and a 429 pauses delivery for the retry_after the API asked for; while
+    Telegram is unreachable or failing, delivery pauses with exponential backoff.
+    """
+
+    def __init__(self, window: float = ALERT_COALESCE_WINDOW, max_length: int = TELEGRAM_MAX_MESSAGE_LENGTH):
+        self.window = window
+        self.max_length = max_length
+        self.pending: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self.recent: Dict[tuple, float] = {}  # key -> when it was last taken for delivery
+        self.pruned_at = 0.0
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+        self.coalesced = 0
+        self.sent = 0
+        self.failed = 0
+        self.outages = 0  # consecutive flushes that found Telegram down
+
+    def submit(self, account_name: str, domain: str, reason: str, client_ip: str = ""):
+        key = (account_name, domain, client_ip)
+        now = time.time()
+        with self.lock:
+            alert = self.pending.get(key)
+            if alert is None:
+                self.pending[key] = {"account_name": account_name, "domain": domain, "reason": reason,
+                                     "client_ip": client_ip, "hits": 1, "first_seen": now, "last_seen": now,
+                                     "due": max(now, self.recent.get(key, 0.0) + self.window)}
+            else:
+                alert["hits"] += 1
+                alert["last_seen"] = now
+                self.coalesced += 1
+
+    def take_due(self, force: bool = False) -> list:
+        """Pop alerts that are due (all of them when force is set)."""
+        now = time.time()
+        with self.lock:
+            if now < self.paused_until and not force:
+                return []
+            if now - self.pruned_at >= self.window:
+                self.recent = {key: at for key, at in self.recent.items() if now - at < self.window}
+                self.pruned_at = now
+            due = [key for key, alert in self.pending.items() if force or alert["due"] <= now]
+            for key in due:
+                self.recent[key] = now
+            return [self.pending.pop(key) for key in due]
+
+    def defer(self, alerts: list, retry_after: float):
+        """Put unsent alerts back at the front of the queue and pause delivery."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + retry_after)
+            for alert in reversed(alerts):
+                key = (alert["account_name"], alert["domain"], alert["client_ip"])
+                queued = self.pending.pop(key, None)
+                if queued:
+                    alert["hits"] += queued["hits"]
+                    alert["last_seen"] = queued["last_seen"]
+                self.pending[key] = alert
+                self.pending.move_to_end(key, last=False)
+
+    @staticmethod
+    def format(alert: Dict[str, Any], markdown: bool = True) -> str:
+        return NextDNSManager.format_alert(alert["account_name"], alert["domain"], alert["reason"],
+                                           alert["client_ip"], alert["hits"], markdown)
+
+    def pack(self, alerts: list) -> list:
+        """Group alerts into (text, alerts) batches that fit in one Telegram message."""
+        batches = []
+        text, group = "", []
+        for alert in alerts:
+            block = self.format(alert)
+            if group and len(text) + 2 + len(block) > self.max_length:
+                batches.append((text, group))
+                text, group = "", []
+            text = text + "\n\n" + block if text else block[:self.max_length]
+            group.append(alert)
+        if group:
+            batches.append((text, group))
+        return batches
+
+    def outage_delay(self) -> float:
+        self.outages += 1
+        return min(ALERT_RETRY_MAX, ALERT_RETRY_BASE * 2 ** (self.outages - 1))
+
+    def flush(self, send, force: bool = False) -> int:
+        """
+        Send due alerts with send(text, markdown) -> (status, retry_after), status being
+        the HTTP status (0 when Telegram could not be reached).
+        Returns the number of messages delivered.
+        """
+        sent = 0
+        batches = self.pack(self.take_due(force))
+        for i, (text, group) in enumerate(batches):
+            status, retry_after = send(text, True)
+            if status == 200:
+                sent += 1
+                self.sent += len(group)
+                self.outages = 0
+                continue
+            if status != 400:
+                self.defer([a for _, g in batches[i:] for a in g], retry_after or self.outage_delay())
+                break
+            # a 400 is usually formatting Telegram could not parse: resend each alert on its
+            # own as plain text, so one bad alert can't take the rest of the batch down with it
+            for j, alert in enumerate(group):
+                status, retry_after = send(self.format(alert, markdown=False), False)
+                if status == 200:
+                    sent += 1
+                    self.sent += 1
+                elif status == 400:
+                    self.failed += 1
+                else:
+                    self.defer(group[j:] + [a for _, g in batches[i + 1:] for a in g],
+                               retry_after or self.outage_delay())
+                    return sent
+        return sent
+
+
+class AlertQueue:
+    """
+    Bounded hand-off between the poll loops and the alert sender pool.
+    When full, "drop-oldest" discards the oldest queued alert, "block" makes the
+    producer wait, and "spill" appends the alert to a JSONL file that senders
+    read back once the queue has drained.
+    """
+
+    def __init__(self, maxsize: int = ALERT_QUEUE_SIZE, policy: str = "drop-oldest", spill_file: str = ALERT_SPILL_FILE):
+        self.queue: queue.Queue = queue.Queue(maxsize)
+        self.policy = policy
+        self.spill_file = spill_file
+        self.spill_lock = threading.Lock()
+        self.dropped = 0
+        self.spilled = 0
+
+    def put(self, alert: AlertEvent):
+        if self.policy == "block":
+            self.queue.put(alert)
+            return
+        try:
+            self.queue.put_nowait(alert)
+            return
+        except queue.Full:
+            pass
+        if self.policy == "spill":
+            self.spill(alert)
+            return
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(alert)
+                return
+            except queue.Full:
+                continue
+
+    def spill(self, alert: AlertEvent):
+        with self.spill_lock:
+            with open(self.spill_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(alert._asdict(), ensure_ascii=False) + "\n")
+            self.spilled += 1
+
+    def unspill(self) -> list:
+        with self.spill_lock:
+            if not os.path.exists(self.spill_file):
+                return []
+            with open(self.spill_file, "r", encoding="utf-8") as f:
+                alerts = [AlertEvent.from_dict(json.loads(line)) for line in f if line.strip()]
+            os.remove(self.spill_file)
+            return alerts
+
+    def get_batch(self, timeout: float, max_items: int = 100) -> list:
+        """Wait up to timeout for alerts; falls back to spilled alerts when the queue is empty."""
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return self.unspill()
+        while len(batch) < max_items:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def __len__(self) -> int:
+        return self.queue.qsize()
+
+
+def loads_json(data):
+    """Decode a whole JSON body, with orjson when it is installed."""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+class LogPageStream:
+    """
+    Incremental parser for a /logs response body.
+    Entries of the top-level "data" array are decoded one at a time as chunks arrive,
+    so a page is never materialised as a whole document; the rest of the document
+    (meta / pagination) is parsed by close() once the array has ended.
+    """
+
+    DATA_ARRAY = re.compile(r'"data"\s*:\s*\[')
+    SEPARATORS = re.compile(r'[\s,]*')
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.scanner = json.JSONDecoder()
+        self.buffer = ""
+        self.head: str = None  # document text before the array, once found
+        self.in_array = False
+        self.count = 0
+
+    def feed(self, chunk: bytes) -> list:
+        """Add a chunk; returns the entries it completed."""
+        self.buffer += self.decoder.decode(chunk)
+        if self.head is None:
+            match = self.DATA_ARRAY.search(self.buffer)
+            if not match:
+                return []
+            self.head = self.buffer[:match.start()] + '"data":[]'
+            self.buffer = self.buffer[match.end():]
+            self.in_array = True
+        entries = []
+        if self.in_array:
+            text, pos = self.buffer, 0
+            skip, scan = self.SEPARATORS.match, self.scanner.scan_once
+            while True:
+                pos = skip(text, pos).end()
+                if pos == len(text):
+                    break
+                if text[pos] == "]":
+                    pos += 1
+                    self.in_array = False
+                    break
+                try:
+                    entry, pos = scan(text, pos)
+                except (StopIteration, ValueError):
+                    break  # entry continues in the next chunk
+                entries.append(entry)
+            self.buffer = text[pos:]
+            self.count += len(entries)
+        return entries
+
+    def close(self) -> Dict[str, Any]:
+        """The document without its entries ("data" is empty); raises ValueError if the body was cut short."""
+        self.buffer += self.decoder.decode(b"", final=True)
+        if self.head is None:
+            return loads_json(self.buffer) if self.buffer.strip() else {}
+        if self.in_array:
+            raise ValueError("truncated /logs response")
+        return json.loads(self.head + self.buffer)
+
+
+def parse_log_timestamp(value) -> int:
+    """A /logs timestamp (ISO 8601 or unix ms) as integer unix milliseconds."""
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        if value.isdigit():
+            return int(value)
+        return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() * 1000)
+    except (AttributeError, ValueError):
+        return int(time.time() * 1000)
+
+
+def iter_sse_events(lines):
+    """
+    Minimal server-sent events parser over decoded lines. Yields (id, data) per event,
+    and (None, None) for comments / keep-alives so the caller regains control while idle.
+    """
+    event_id, data = None, []
+    for line in lines:
+        if not line:
+            if data:
+                yield event_id, "\n".join(data)
+                data = []
+            continue
+        if line.startswith(":"):
+            yield None, None
+            continue
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            data.append(value)
+        elif field == "id":
+            event_id = value
+
+
+class LogRecord(NamedTuple):
+    """The fields alerting needs from a blocked log entry, built once at ingestion."""
+    domain: str      # lower-cased and interned: the same few names repeat all day
+    timestamp: int   # unix ms
+    client_ip: str
+    device: str
+
+
+class LogCursor:
+    """
+    One profile's ingestion position while a poll reads pages.
+    "from" is inclusive, so entries already seen at the previous cursor timestamp are
+    dropped; of the new entries only blocked ones are kept, as LogRecords.
+    """
+
+    def __init__(self, state: Dict[str, Any] = None):
+        state = state or {}
+        self.last_ts = state.get("last_ts")
+        self.last_keys = set(state.get("last_keys", []))
+        self.first_at_last_ts: Dict[str, Any] = None  # keys are only built when a timestamp repeats
+        self.stream_id = state.get("stream_id")  # where a log stream resumes from
+        self.ts_prefix, self.ts_base = None, 0
+        self.blocked: list = []
+        self.ingested = 0
+
+    @staticmethod
+    def key(log: Dict[str, Any]) -> str:
+        return "{}_{}_{}".format(log.get("name") or log.get("domain") or "", log.get("timestamp"), log.get("clientIp") or "")
+
+    def timestamp(self, value) -> int:
+        """parse_log_timestamp, memoising the whole-second part that consecutive entries share."""
+        if isinstance(value, str) and len(value) == 24 and value[19] == "." and value[23] == "Z":
+            prefix = value[:19]
+            if prefix != self.ts_prefix:
+                self.ts_prefix, self.ts_base = prefix, parse_log_timestamp(prefix + "Z")
+            return self.ts_base + int(value[20:23])
+        return parse_log_timestamp(value)
+
+    def record(self, log: Dict[str, Any]) -> LogRecord:
+        device = log.get("device") or {}
+        return LogRecord(
+            sys.intern((log.get("name") or log.get("domain") or "").strip().lower()),
+            self.timestamp(log.get("timestamp")),
+            log.get("clientIp") or device.get("id", "") or "",
+            device.get("name") or "",
+        )
+
+    def keys_at_last_ts(self) -> Set[str]:
+        if self.last_keys is None:
+            self.last_keys = {self.key(self.first_at_last_ts)}
+        return self.last_keys
+
+    def add(self, log: Dict[str, Any]):
+        ts = log.get("timestamp")
+        if ts == self.last_ts:
+            keys = self.keys_at_last_ts()
+            key = self.key(log)
+            if key in keys:
+                return
+            keys.add(key)
+        else:
+            self.last_ts = ts
+            self.last_keys = None
+            self.first_at_last_ts = log
+        self.ingested += 1
+        status = log.get("status")
+        if status == "blocked" or status == 2:
+            self.blocked.append(self.record(log))
+
+    @staticmethod
+    def position(state: Dict[str, Any]) -> int:
+        """How far a persisted cursor has read, as unix ms (-1 if it has read nothing)."""
+        last_ts = (state or {}).get("last_ts")
+        return parse_log_timestamp(last_ts) if last_ts is not None else -1
+
+    def state(self) -> Dict[str, Any]:
+        state = {"last_ts": self.last_ts, "last_keys": sorted(self.keys_at_last_ts())}
+        if self.stream_id is not None:
+            state["stream_id"] = self.stream_id
+        return state
+
+
+class DedupeCache:
+    """
+    Per-profile record of alerted requests, kept in insertion (= time) order.
+    Ids are stored as 64-bit hashes; entries older than the TTL or beyond the size
+    cap are evicted from the old end, so memory stays flat and recent ids are never
+    the ones dropped.
+    """
+
+    def __init__(self, ttl: float = DEDUPE_TTL_SECONDS, max_size: int = DEDUPE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: "OrderedDict[int, float]" = OrderedDict()
+
+    @staticmethod
+    def key(req_id: str) -> int:
+        """Signed 64-bit hash, so keys fit an SQLite INTEGER."""
+        return int.from_bytes(hashlib.blake2b(req_id.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+    @classmethod
+    def from_state(cls, items) -> "DedupeCache":
+        """Accepts persisted [key, seen_at] pairs or legacy request id strings."""
+        cache = cls()
+        now = time.time()
+        pairs = [(cls.key(item), now) if isinstance(item, str) else (int(item[0]), float(item[1])) for item in items]
+        for key, seen_at in sorted(pairs, key=lambda p: p[1]):
+            cache.entries[key] = seen_at
+        cache.expire(now)
+        return cache
+
+    def add(self, key: int, now: float = None) -> bool:
+        """Record key; returns False if it was already seen within the TTL."""
+        now = time.time() if now is None else now
+        seen_at = self.entries.get(key)
+        if seen_at is not None and now - seen_at < self.ttl:
+            return False
+        self.entries[key] = now
+        self.entries.move_to_end(key)
+        return True
+
+    def expire(self, now: float = None) -> list:
+        """Evict expired and over-capacity entries; returns the evicted keys."""
+        now = time.time() if now is None else now
+        evicted = []
+        while self.entries:
+            key, seen_at = next(iter(self.entries.items()))
+            if now - seen_at < self.ttl and len(self.entries) <= self.max_size:
+                break
+            self.entries.popitem(last=False)
+            evicted.append(key)
+        return evicted
+
+    def dump(self) -> list:
+        return [[key, seen_at] for key, seen_at in self.entries.items()]
+
+    def __contains__(self, key: int) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class SpaceSaving:
+    """
+    Space-saving top-K summary (Metwally et al.): at most `capacity` counters. An unseen
+    item replaces the smallest counter and inherits its count as the error bound, so any
+    item seen more than total / capacity times is guaranteed to be present.
+    """
+
+    __slots__ = ("capacity", "counts", "errors", "heap")
+
+    def __init__(self, capacity: int = TOP_K_CAPACITY):
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.heap: list = []  # one (count, item) per item; counts only grow, so entries may lag
+
+    def add(self, item: str, n: int = 1):
+        counts = self.counts
+        count = counts.get(item)
+        if count is not None:
+            counts[item] = count + n
+            return
+        if len(counts) < self.capacity:
+            counts[item] = n
+            self.errors[item] = 0
+            heapq.heappush(self.heap, (n, item))
+            return
+        # find the true minimum, refreshing entries that lag behind their counter
+        while True:
+            floor, victim = heapq.heappop(self.heap)
+            if counts[victim] == floor:
+                break
+            heapq.heappush(self.heap, (counts[victim], victim))
+        del counts[victim], self.errors[victim]
+        counts[item] = floor + n
+        self.errors[item] = floor
+        heapq.heappush(self.heap, (floor + n, item))
+
+
+class ProfileTraffic:
+    """
+    One profile's blocked-traffic aggregates, bucketed by log time: per-minute blocked /
+    denylist-match counts for the last 24h, and hourly space-saving summaries of blocked
+    domains and clients. Partial windows weight the oldest bucket by its overlap.
+    """
+
+    MINUTES = 24 * 60
+    HOURS = 25  # 24 full hours plus the partially covered oldest one
+
+    def __init__(self):
+        self.minute = [-1] * self.MINUTES  # minute number each slot currently holds
+        self.blocked = [0] * self.MINUTES
+        self.matched = [0] * self.MINUTES
+        self.hour = [-1] * self.HOURS
+        self.domains: list = [None] * self.HOURS
+        self.clients: list = [None] * self.HOURS
+
+    def minute_slot(self, minute: int) -> int:
+        slot = minute % self.MINUTES
+        if self.minute[slot] != minute:
+            self.minute[slot], self.blocked[slot], self.matched[slot] = minute, 0, 0
+        return slot
+
+    def hour_slot(self, hour: int) -> int:
+        slot = hour % self.HOURS
+        if self.hour[slot] != hour:
+            self.hour[slot], self.domains[slot], self.clients[slot] = hour, SpaceSaving(), SpaceSaving()
+        return slot
+
+    def add(self, blocked: list, hits: list, now_minute: int):
+        oldest = now_minute - self.MINUTES
+        by_hour: Dict[int, tuple] = {}  # hour slot -> (domains, clients) seen in this batch
+        current = None  # records arrive in time order, so slots are looked up once per minute
+        for record, hit in zip(blocked, hits):
+            minute = record.timestamp // 60000
+            if minute != current:
+                if minute <= oldest or self.minute[minute % self.MINUTES] > minute:
+                    current = None
+                    continue  # older than the ring holds
+                current, slot = minute, self.minute_slot(minute)
+                domains, clients = by_hour.setdefault(self.hour_slot(minute // 60), ([], []))
+            self.blocked[slot] += 1
+            if hit:
+                self.matched[slot] += 1
+            domains.append(record.domain)
+            clients.append(record.client_ip or record.device or "unknown")
+        # repeated names within a batch become one weighted update
+        for hour, (domains, clients) in by_hour.items():
+            for item, n in Counter(domains).items():
+                self.domains[hour].add(item, n)
+            for item, n in Counter(clients).items():
+                self.clients[hour].add(item, n)
+
+    def counts(self, seconds: int, now_minute: int) -> tuple:
+        """(blocked, matched) over the last `seconds`, by whole minutes."""
+        first = now_minute - seconds // 60
+        blocked = matched = 0
+        for slot, minute in enumerate(self.minute):
+            if first < minute <= now_minute:
+                blocked += self.blocked[slot]
+                matched += self.matched[slot]
+        return blocked, matched
+
+    def per_minute(self, seconds: int, now_minute: int) -> list:
+        """[unix minute start, blocked, matched] for each minute with traffic in the window, oldest first."""
+        first = now_minute - seconds // 60
+        rows = [[minute * 60, self.blocked[slot], self.matched[slot]]
+                for slot, minute in enumerate(self.minute) if first < minute <= now_minute]
+        return sorted(rows)
+
+    def top(self, dimension: str, seconds: int, now_minute: int, n: int) -> list:
+        """Merged hourly summaries covering the window: [item, estimated count, max overcount], largest first."""
+        summaries = self.domains if dimension == "domains" else self.clients
+        start = now_minute - seconds // 60  # window start, in minutes
+        totals: Dict[str, list] = {}
+        for slot, hour in enumerate(self.hour):
+            if hour < 0 or hour * 60 > now_minute or (hour + 1) * 60 <= start:
+                continue
+            # hour buckets straddling the window start count in proportion to their overlap
+            weight = min(1.0, ((hour + 1) * 60 - start) / 60)
+            summary = summaries[slot]
+            for item, count in summary.counts.items():
+                total = totals.setdefault(item, [0.0, 0.0])
+                total[0] += count * weight
+                total[1] += summary.errors[item] * weight
+        ranked = sorted(totals.items(), key=lambda kv: kv[1][0], reverse=True)[:n]
+        return [[item, round(count), round(error)] for item, (count, error) in ranked]
+
+
+class TrafficAnalytics:
+    """
+    Rolling per-profile aggregates over blocked traffic, fed by collect_alerts from
+    what the monitor already ingests, so the dashboard and /analytics need no API calls.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles: Dict[str, ProfileTraffic] = {}
+
+    def add(self, profile_id: str, blocked: list, hits: list):
+        if not blocked:
+            return
+        now_minute = int(time.time()) // 60
+        with self.lock:
+            traffic = self.profiles.get(profile_id)
+            if traffic is None:
+                traffic = self.profiles[profile_id] = ProfileTraffic()
+            traffic.add(blocked, hits, now_minute)
+
+    def forget(self, profile_id: str):
+        with self.lock:
+            self.profiles.pop(profile_id, None)
+
+    def counts(self, profile_id: str, seconds: int) -> tuple:
+        with self.lock:
+            traffic = self.profiles.get(profile_id)
+            return traffic.counts(seconds, int(time.time()) // 60) if traffic else (0, 0)
+
+    def summary(self, profile_id: str, seconds: int, top: int = TOP_K_SHOWN, minutes: bool = False) -> Dict[str, Any]:
+        now_minute = int(time.time()) // 60
+        with self.lock:
+            traffic = self.profiles.get(profile_id)
+            if traffic is None:
+                return None
+            blocked, matched = traffic.counts(seconds, now_minute)
+            summary = {
+                "blocked": blocked,
+                "denylist_matches": matched,
+                "blocked_per_minute": round(blocked / (seconds / 60), 2),
+                "top_domains": traffic.top("domains", seconds, now_minute, top),
+                "top_clients": traffic.top("clients", seconds, now_minute, top),
+            }
+            if minutes:
+                summary["minutes"] = traffic.per_minute(seconds, now_minute)
+            return summary
+
+
+class JsonStateStore:
+    """
+    Original state.json format.
+    Delta calls only mark the state dirty; save() rewrites the whole file, but only
+    when something changed, and atomically via a temp file + rename.
+    merge_from names the other state files of a (previously) sharded fleet: on load each
+    profile takes the cursor and denylist of whichever file has read it furthest, and
+    the union of their dedupe entries, so changing --shards never rewinds a profile.
+    owns(profile_id) limits what is loaded to this process's own profiles; deleted
+    profiles are also purged from the merge_from files on the next save.
+    """
+
+    def __init__(self, path: str = STATE_FILE, merge_from=(), owns=None):
+        self.path = path
+        self.merge_from = list(merge_from)
+        self.owns = owns
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.deleted: set = set()
+
+    @staticmethod
+    def read(path: str) -> Dict[str, Any]:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    @staticmethod
+    def write(path: str, data: Dict[str, Any]):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self) -> Dict[str, Any]:
+        data = self.read(self.path)
+        others = []
+        for path in self.merge_from:
+            try:
+                others.append(self.read(path))
+            except (OSError, ValueError):
+                continue
+        merged = self.merge(data, others) if others else data
+        if self.owns is not None:
+            merged = dict(merged, **{section: {pid: value for pid, value in (merged.get(section) or {}).items()
+                                               if self.owns(pid)} for section in STATE_PROFILE_SECTIONS})
+        if merged != data:
+            # taken from another file or dropped here: rewrite this one on the next save
+            self.dirty = True
+        return merged
+
+    @staticmethod
+    def merge(data: Dict[str, Any], others: list) -> Dict[str, Any]:
+        cursors = dict(data.get("log_cursors") or {})
+        denylists = dict(data.get("denylist_cache") or {})
+        now = time.time()
+        processed: Dict[str, Dict[int, float]] = {}
+        for source in [data] + others:
+            for profile_id, items in (source.get("processed_requests") or {}).items():
+                seen = processed.setdefault(profile_id, {})
+                for item in items:
+                    key, seen_at = (DedupeCache.key(item), now) if isinstance(item, str) else (int(item[0]), float(item[1]))
+                    seen[key] = max(seen_at, seen.get(key, 0.0))
+        for source in others:
+            for profile_id, cursor in (source.get("log_cursors") or {}).items():
+                mine = cursors.get(profile_id)
+                if mine is None or LogCursor.position(cursor) > LogCursor.position(mine):
+                    cursors[profile_id] = cursor
+                    if profile_id in (source.get("denylist_cache") or {}):
+                        denylists[profile_id] = source["denylist_cache"][profile_id]
+            for profile_id, domains in (source.get("denylist_cache") or {}).items():
+                denylists.setdefault(profile_id, domains)
+        merged = dict(data, log_cursors=cursors, denylist_cache=denylists)
+        merged["processed_requests"] = {pid: [[k, t] for k, t in seen.items()] for pid, seen in processed.items()}
+        return merged
+
+    def add_processed(self, profile_id: str, entries):
+        self.dirty = True
+
+    def remove_processed(self, profile_id: str, keys):
+        self.dirty = True
+
+    def set_cursor(self, profile_id: str, cursor: Dict[str, Any]):
+        self.dirty = True
+
+    def set_denylist(self, profile_id: str, domains: list):
+        self.dirty = True
+
+    def delete_profile(self, profile_id: str):
+        self.dirty = True
+        self.deleted.add(profile_id)
+
+    def save(self, snapshot):
+        """snapshot() returns the full state dict; it is only called when there is something to write."""
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            self.write(self.path, snapshot())
+            if self.deleted:
+                self.purge(self.deleted)
+                self.deleted = set()
+
+    def purge(self, profile_ids: set):
+        """Remove deleted profiles from the merge_from files so a later load can't bring them back."""
+        for path in self.merge_from:
+            try:
+                data = self.read(path)
+            except (OSError, ValueError):
+                continue
+            if not any(pid in (data.get(section) or {}) for section in STATE_PROFILE_SECTIONS for pid in profile_ids):
+                continue
+            for section in STATE_PROFILE_SECTIONS:
+                for pid in profile_ids:
+                    (data.get(section) or {}).pop(pid, None)
+            self.write(path, data)
+
+    def close(self):
+        pass
+
+
+class SQLiteStateStore:
+    """
+    SQLite state in WAL mode.
+    Every delta is written as it happens (one row per dedupe key, one row per
+    cursor / denylist), so the cost per alert does not grow with the total state.
+    """
+
+    def __init__(self, path: str = STATE_DB_FILE, import_from: str = STATE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        is_new = not os.path.exists(path)
+        # shard processes may share the database; wait out their write locks
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dedupe ("
+                        "profile_id TEXT NOT NULL, key INTEGER NOT NULL, seen_at REAL NOT NULL, "
+                        "PRIMARY KEY (profile_id, key)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS profile_state ("
+                        "profile_id TEXT NOT NULL, kind TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (profile_id, kind))")
+        if is_new and import_from and os.path.exists(import_from):
+            self.import_json(import_from)
+        self.migrate_processed_table()
+
+    def migrate_processed_table(self):
+        """Earlier databases kept raw request id strings in a "processed" table."""
+        if not self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'processed'").fetchone():
+            return
+        legacy: Dict[str, list] = {}
+        for profile_id, req_id in self.db.execute("SELECT profile_id, req_id FROM processed"):
+            legacy.setdefault(profile_id, []).append(req_id)
+        for profile_id, req_ids in legacy.items():
+            self.add_processed(profile_id, DedupeCache.from_state(req_ids).dump())
+        self.db.execute("DROP TABLE processed")
+
+    def import_json(self, path: str):
+        """One-off migration from an existing state.json."""
+        try:
+            data = JsonStateStore(path).load()
+        except Exception:
+            return
+        for profile_id, items in data.get("processed_requests", {}).items():
+            self.add_processed(profile_id, DedupeCache.from_state(items).dump())
+        for profile_id, cursor in data.get("log_cursors", {}).items():
+            self.set_cursor(profile_id, cursor)
+        for profile_id, domains in data.get("denylist_cache", {}).items():
+            self.set_denylist(profile_id, domains)
+
+    def load(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {"processed_requests": {}, "log_cursors": {}, "denylist_cache": {}}
+        with self.lock:
+            for profile_id, key, seen_at in self.db.execute("SELECT profile_id, key, seen_at FROM dedupe ORDER BY seen_at"):
+                data["processed_requests"].setdefault(profile_id, []).append([key, seen_at])
+            for profile_id, kind, value in self.db.execute("SELECT profile_id, kind, data FROM profile_state"):
+                key = "log_cursors" if kind == "cursor" else "denylist_cache"
+                data[key][profile_id] = json.loads(value)
+        return data
+
+    def add_processed(self, profile_id: str, entries):
+        """entries: (key, seen_at) pairs from DedupeCache."""
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO dedupe (profile_id, key, seen_at) VALUES (?, ?, ?)",
+                                [(profile_id, key, seen_at) for key, seen_at in entries])
+
+    def remove_processed(self, profile_id: str, keys):
+        with self.lock:
+            self.db.executemany("DELETE FROM dedupe WHERE profile_id = ? AND key = ?",
+                                [(profile_id, key) for key in keys])
+
+    def _set(self, profile_id: str, kind: str, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO profile_state (profile_id, kind, data) VALUES (?, ?, ?)",
+                            (profile_id, kind, json.dumps(value, ensure_ascii=False)))
+
+    def set_cursor(self, profile_id: str, cursor: Dict[str, Any]):
+        self._set(profile_id, "cursor", cursor)
+
+    def set_denylist(self, profile_id: str, domains: list):
+        self._set(profile_id, "denylist", domains)
+
+    def delete_profile(self, profile_id: str):
+        with self.lock:
+            self.db.execute("DELETE FROM dedupe WHERE profile_id = ?", (profile_id,))
+            self.db.execute("DELETE FROM profile_state WHERE profile_id = ?", (profile_id,))
+
+    def save(self, snapshot):
+        # deltas are already durable; nothing to rewrite
+        pass
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def parse_since(value: str) -> float:
+    """Unix time from a relative age ("30m", "24h", "7d") or an ISO date/time."""
+    value = value.strip()
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    if value[-1:].lower() in units and value[:-1].replace(".", "", 1).isdigit():
+        return time.time() - float(value[:-1]) * units[value[-1].lower()]
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+class AlertHistory:
+    """
+    Every alert the monitor raises, in an indexed SQLite table (WAL) for ad-hoc queries
+    such as "which clients hit X this week". Inserts are buffered and written in batches
+    by a background thread, so the poll path only appends to a deque; rows past the
+    retention period are deleted in chunks by periodic compaction.
+    Domains are also stored label-reversed (com.example.www) so "X and its subdomains"
+    is an index range scan.
+    """
+
+    def __init__(self, path: str = ALERT_HISTORY_FILE, retention_days: float = ALERT_HISTORY_RETENTION_DAYS):
+        self.path = path
+        self.retention_days = retention_days
+        self.lock = threading.Lock()
+        self.pending: deque = deque()
+        self.wake = threading.Event()
+        self.writer: threading.Thread = None
+        self.running = False
+        self.written = 0
+        self.dropped = 0
+        self.compacted_at = 0.0
+        # shard processes share the database; wait out their write locks
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        # freed pages are returned by incremental_vacuum after compaction (new databases only)
+        self.db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS alerts ("
+                        "id INTEGER PRIMARY KEY, at INTEGER NOT NULL, profile_id TEXT NOT NULL, "
+                        "account_name TEXT NOT NULL, domain TEXT NOT NULL, rdomain TEXT NOT NULL, "
+                        "client_ip TEXT NOT NULL, device TEXT NOT NULL)")
+        for name, columns in (("profile", "profile_id, at"), ("rdomain", "rdomain, at"),
+                              ("client", "client_ip, at"), ("at", "at")):
+            self.db.execute("CREATE INDEX IF NOT EXISTS alerts_{} ON alerts ({})".format(name, columns))
+        # queries get their own connection so WAL readers never wait for the writer
+        self.reader = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.read_lock = threading.Lock()
+
+    @staticmethod
+    def reverse_domain(domain: str) -> str:
+        return ".".join(reversed(domain.split(".")))
+
+    def add(self, alert: AlertEvent):
+        if len(self.pending) >= ALERT_HISTORY_QUEUE_SIZE:
+            self.dropped += 1
+            return
+        self.pending.append(alert)
+        if len(self.pending) >= ALERT_HISTORY_BATCH:
+            self.wake.set()
+
+    def flush(self) -> int:
+        """
+        Write everything buffered, ALERT_HISTORY_BATCH rows per transaction.
+        A batch that fails is rolled back and put back at the front of the buffer.
+        """
+        count = 0
+        while self.pending:
+            alerts = []
+            while self.pending and len(alerts) < ALERT_HISTORY_BATCH:
+                alerts.append(self.pending.popleft())
+            batch = [(alert.timestamp or int(time.time() * 1000), alert.profile_id, alert.account_name,
+                      alert.domain, self.reverse_domain(alert.domain), alert.client_ip, alert.device)
+                     for alert in alerts]
+            with self.lock:
+                try:
+                    self.db.execute("BEGIN")
+                    self.db.executemany("INSERT INTO alerts (at, profile_id, account_name, domain, rdomain, client_ip, "
+                                        "device) VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+                    self.db.execute("COMMIT")
+                except sqlite3.Error:
+                    if self.db.in_transaction:
+                        self.db.execute("ROLLBACK")
+                    self.pending.extendleft(reversed(alerts))
+                    raise
+            count += len(batch)
+            self.written += len(batch)
+        return count
+
+    def compact(self, chunk: int = 10000) -> int:
+        """Delete alerts past the retention period and hand the freed pages back to the filesystem."""
+        self.compacted_at = time.time()
+        if not self.retention_days:
+            return 0
+        cutoff = int((time.time() - self.retention_days * 86400) * 1000)
+        deleted = 0
+        while True:
+            # small chunks keep each write lock short for the other writers
+            with self.lock:
+                n = self.db.execute("DELETE FROM alerts WHERE id IN (SELECT id FROM alerts WHERE at < ? LIMIT ?)",
+                                    (cutoff, chunk)).rowcount
+            deleted += n
+            if n < chunk:
+                break
+        if deleted:
+            with self.lock:
+                # executescript steps incremental_vacuum to completion (execute frees a single page);
+                # the freed pages leave the file at the checkpoint
+                self.db.executescript("PRAGMA incremental_vacuum; PRAGMA wal_checkpoint(TRUNCATE); PRAGMA optimize;")
+        return deleted
+
+    def run(self):
+        while self.running:
+            self.wake.wait(ALERT_HISTORY_FLUSH_SECONDS)
+            self.wake.clear()
+            try:
+                self.flush()
+                if time.time() - self.compacted_at >= ALERT_HISTORY_COMPACT_SECONDS:
+                    self.compact()
+            except sqlite3.Error as e:
+                print(f"❌ Alert history write failed: {e}")
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.writer is not None:
+            self.writer.join(timeout=HTTP_TIMEOUT)
+            self.writer = None
+        self.flush()
+
+    def query(self, profile_id: str = None, domain: str = None, subdomains: bool = False, client_ip: str = None,
+              since: float = None, until: float = None, group_by: str = None, limit: int = 100) -> list:
+        """
+        Matching alerts, newest first, or with group_by one row per distinct value
+        (hits, first and last time), most hits first. Times are unix seconds.
+        limit is clamped to 1..ALERT_HISTORY_MAX_ROWS.
+        """
+        limit = max(1, min(int(limit), ALERT_HISTORY_MAX_ROWS))
+        where, args = [], []
+        if profile_id:
+            where.append("profile_id = ?")
+            args.append(profile_id)
+        if domain:
+            rdomain = self.reverse_domain(domain.strip().lower().rstrip("."))
+            if subdomains:
+                # every rdomain under "com.example." sorts between it and "com.example/"
+                where.append("(rdomain = ? OR (rdomain >= ? AND rdomain < ?))")
+                args += [rdomain, rdomain + ".", rdomain + "/"]
+            else:
+                where.append("rdomain = ?")
+                args.append(rdomain)
+        if client_ip:
+            where.append("client_ip = ?")
+            args.append(client_ip)
+        if since is not None:
+            where.append("at >= ?")
+            args.append(int(since * 1000))
+        if until is not None:
+            where.append("at < ?")
+            args.append(int(until * 1000))
+        clause = (" WHERE " + " AND ".join(where)) if where else ""
+        if group_by:
+            if group_by not in ALERT_HISTORY_GROUPS:
+                raise ValueError("group_by must be one of " + ", ".join(ALERT_HISTORY_GROUPS))
+            sql = ("SELECT {0}, COUNT(*) AS hits, MIN(at), MAX(at) FROM alerts{1} GROUP BY {0} "
+                   "ORDER BY hits DESC LIMIT ?").format(group_by, clause)
+            with self.read_lock:
+                rows = self.reader.execute(sql, args + [limit]).fetchall()
+            return [{group_by: value, "hits": hits, "first": first / 1000, "last": last / 1000}
+                    for value, hits, first, last in rows]
+        sql = ("SELECT at, profile_id, account_name, domain, client_ip, device FROM alerts{} "
+               "ORDER BY at DESC LIMIT ?").format(clause)
+        with self.read_lock:
+            rows = self.reader.execute(sql, args + [limit]).fetchall()
+        return [{"at": at / 1000, "profile_id": pid, "account_name": name, "domain": domain_, "client_ip": ip,
+                 "device": device} for at, pid, name, domain_, ip, device in rows]
+
+    def close(self):
+        with self.read_lock:
+            self.reader.close()
+        with self.lock:
+            self.db.close()
+
+
+class ShardRing:
+    """Consistent-hash ring mapping profile ids to shard indexes."""
+
+    def __init__(self, shards: int, vnodes: int = SHARD_VNODES):
+        self.shards = shards
+        self.ring = sorted((self.hash(f"shard-{i}#{v}"), i) for i in range(shards) for v in range(vnodes))
+        self.points = [point for point, _ in self.ring]
+
+    @staticmethod
+    def hash(value: str) -> int:
+        # stable across processes, unlike hash()
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def shard_for(self, profile_id: str) -> int:
+        i = bisect.bisect(self.points, self.hash(profile_id)) % len(self.ring)
+        return self.ring[i][1]
+
+
+class NextDNSManager:
+    def __init__(self, engine: str = "thread", alert_overflow: str = "drop-oldest", state_backend: str = "json",
+                 shard: tuple = None, api_rps: float = API_REQUESTS_PER_SECOND,
+                 api_key_rps: float = API_KEY_REQUESTS_PER_SECOND, trace: bool = False,
+                 trace_file: str = TRACE_FILE, alert_history_days: float = ALERT_HISTORY_RETENTION_DAYS):
         self.accounts_file = ACCOUNTS_FILE
         self.bot_file = BOT_SETTINGS_FILE
         self.state_file = STATE_FILE
+        # shard: (index, count) when running as one process of a sharded fleet
+        self.shard = shard
+        self.shard_ring = ShardRing(shard[1]) if shard else None
+        spill_file = ALERT_SPILL_FILE
+        if shard:
+            # JSON state and alert spill files can't be shared between processes
+            self.state_file = "state.shard{}.json".format(shard[0])
+            spill_file = "alerts_spill.shard{}.jsonl".format(shard[0])
+            trace_file = "{0}.shard{2}{1}".format(*os.path.splitext(trace_file), shard[0])
+        self.state_lock = threading.RLock()
 
         # إنشاء الملفات إذا لم تكن موجودة
         self.ensure_files_exist()
         
         self.accounts: Dict[str, Dict[str, Any]] = self.load_accounts()
         self.bot_settings: Dict[str, str] = self.load_bot_settings()
+        if state_backend == "sqlite":
+            self.state_store = SQLiteStateStore()
+        else:
+            # profiles move between state.json and the shard files whenever --shards changes
+            siblings = [STATE_FILE] + sorted(glob.glob("state.shard*.json"))
+            self.state_store = JsonStateStore(self.state_file, [p for p in siblings if p != self.state_file],
+                                              owns=self.owns_profile)
         self.state: Dict[str, Any] = self.load_state()
 
-        # processed requests: profile_id -> set of request_ids
-        self.processed_requests: Dict[str, Set[str]] = {
-            k: set(v) for k, v in self.state.get("processed_requests", {}).items()
+        # processed requests: profile_id -> dedupe cache of alerted request ids
+        self.processed_requests: Dict[str, DedupeCache] = {
+            k: DedupeCache.from_state(v) for k, v in self.state.get("processed_requests", {}).items()
         }
         # denylist cache: profile_id -> list of domains
         self.denylist_cache: Dict[str, list] = self.state.get("denylist_cache", {})
+        # log cursors: profile_id -> {"last_ts": timestamp of newest log seen, "last_keys": keys seen at that timestamp}
+        self.log_cursors: Dict[str, Dict[str, Any]] = self.state.get("log_cursors", {})
+
+        # thread control
+        self.scheduler: PollScheduler = None
+        self.stream_threads: list = []
+        self.state_saver: threading.Thread = None
+        self.polls: Dict[str, Dict[str, Any]] = {}
+        self.monitoring = False
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        # shards split the request budgets between them
+        self.rate_budget = RateBudget(api_rps / shard[1] if shard else api_rps)
+        self.api_key_rps = api_key_rps / shard[1] if shard else api_key_rps
+        self.key_budgets: Dict[str, RateBudget] = {}
+        self.stop_event = threading.Event()
+        self.async_thread: threading.Thread = None
+        self.async_loop: asyncio.AbstractEventLoop = None
+        self.async_task: asyncio.Task = None
+        self.engine = engine
+        self.alerts = AlertDispatcher()
+        self.alert_queue = AlertQueue(policy=alert_overflow, spill_file=spill_file)
+        self.alert_senders: list = []
+        self.alert_senders_running = False
+        self.alert_history = AlertHistory(ALERT_HISTORY_FILE, alert_history_days)
+
+        # dashboard snapshots: profile_id -> {"denylist_size", "recent_blocks", "updated_at"}
+        self.snapshots: Dict[str, Dict[str, Any]] = {}
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_refreshing: Set[str] = set()
+        self.snapshot_pool = ThreadPoolExecutor(max_workers=DASHBOARD_FETCH_WORKERS)
+        # monitor feed: profile_id -> deque of (time, custom blocks seen in that poll)
+        self.block_history: Dict[str, deque] = {}
+        self.analytics = TrafficAnalytics()
+
+        # operational visibility for /metrics and /status
+        self.metrics = Metrics()
+        self.worker_status: Dict[str, Dict[str, Any]] = {}
+        self.tracer = Tracer(trace, trace_file)
 
-        # thread control
-        self.monitor_threads: Dict[str, threading.Thread] = {}
-        self.monitoring = False
+        # pooled HTTP sessions: api_key -> session for api.nextdns.io, plus one for Telegram
+        self.http_pool_size = HTTP_POOL_MIN_SIZE
+        self.nextdns_sessions: Dict[str, requests.Session] = {}
+        self.telegram_http: requests.Session = None
+        self.sessions_lock = threading.Lock()
 
     def ensure_files_exist(self):
         """تأكد من وجود جميع الملفات اللازمة"""
@@ -144,46 +1996,223 @@ class NextDNSManager:
 
     def load_state(self) -> Dict[str, Any]:
         try:
-            with open(self.state_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                processed_count = sum(len(v) for v in data.get("processed_requests", {}).values())
-                self.print_info(f"Loaded state with {processed_count} processed requests")
-                return data
+            data = self.state_store.load()
+            processed_count = sum(len(v) for v in data.get("processed_requests", {}).values())
+            self.print_info(f"Loaded state with {processed_count} processed requests")
+            return data
         except Exception as e:
             self.print_error(f"Error loading state: {e}")
             return {}
 
-    def save_state(self):
-        try:
-            state_out = {
-                "processed_requests": {k: list(v) for k, v in self.processed_requests.items()},
-                "denylist_cache": self.denylist_cache,
+    def state_snapshot(self) -> Dict[str, Any]:
+        with self.state_lock:
+            return {
+                "processed_requests": {k: v.dump() for k, v in self.processed_requests.items()},
+                "denylist_cache": dict(self.denylist_cache),
+                "log_cursors": dict(self.log_cursors),
                 "last_saved": datetime.now().isoformat()
             }
-            with open(self.state_file, "w", encoding="utf-8") as f:
-                json.dump(state_out, f, indent=4, ensure_ascii=False)
+
+    def save_state(self):
+        try:
+            with self.tracer.span("save_state"):
+                self.state_store.save(self.state_snapshot)
         except Exception as e:
             self.print_error(f"Error saving state: {e}")
 
+    def forget_profile_state(self, profile_id: str):
+        """Drop every cached/persisted item for a deleted profile."""
+        with self.state_lock:
+            self.denylist_cache.pop(profile_id, None)
+            self.processed_requests.pop(profile_id, None)
+            self.log_cursors.pop(profile_id, None)
+        self.analytics.forget(profile_id)
+        self.state_store.delete_profile(profile_id)
+
+    # -------------------- HTTP sessions --------------------
+    def new_http_session(self) -> requests.Session:
+        """Keep-alive session whose per-host pool is sized to the running monitor workers."""
+        session = requests.Session()
+        # each open log stream pins a connection, so the stream engine must not block on the pool
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.http_pool_size, pool_block=self.engine != "stream")
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def nextdns_session(self, api_key: str) -> requests.Session:
+        """Shared session for one API key, with the key sent as a default header."""
+        with self.sessions_lock:
+            session = self.nextdns_sessions.get(api_key)
+            if session is None:
+                session = self.new_http_session()
+                session.headers["X-Api-Key"] = api_key
+                self.nextdns_sessions[api_key] = session
+            return session
+
+    def request_delay(self, api_key: str) -> float:
+        """Reserve one request from the global budget and from the API key's own; returns the wait."""
+        with self.sessions_lock:
+            key_budget = self.key_budgets.get(api_key)
+            if key_budget is None:
+                key_budget = self.key_budgets[api_key] = RateBudget(self.api_key_rps)
+        return max(self.rate_budget.reserve(), key_budget.reserve())
+
+    def nextdns_get(self, api_key: str, url: str, profile_id: str = None, **kwargs) -> requests.Response:
+        """
+        GET against the NextDNS API within the global and per-key request budgets.
+        429 / 5xx / connection errors are retried with jittered backoff (honouring Retry-After);
+        when they persist, NextDNSAPIError is raised and the profile's circuit breaker counts it.
+        """
+        breaker = self.breaker(profile_id) if profile_id else None
+        if breaker and not breaker.allow():
+            raise CircuitOpenError("circuit open, retry in {:.0f}s".format(breaker.retry_in()))
+        for attempt in range(API_MAX_RETRIES + 1):
+            delay = self.request_delay(api_key)
+            if delay:
+                time.sleep(delay)
+            status, retry_after = None, None
+            try:
+                resp = self.nextdns_session(api_key).get(url, **dict({"timeout": HTTP_TIMEOUT}, **kwargs))
+            except requests.RequestException as e:
+                if kwargs.get("stream") and is_read_timeout(e):
+                    raise  # a stream with nothing to say yet, not an API failure
+                error = str(e) or type(e).__name__
+            else:
+                if resp.status_code not in RETRYABLE_STATUSES:
+                    self.api_call_succeeded(profile_id)
+                    return resp
+                resp.close()
+                status, retry_after = resp.status_code, parse_retry_after(resp.headers.get("Retry-After"))
+                error = "HTTP {}".format(status)
+            delay = self.api_retry_delay(profile_id, attempt, retry_after)
+            if delay is None:
+                break
+            time.sleep(delay)
+        self.api_call_failed(profile_id, error, retry_after)
+        raise NextDNSAPIError(error, status, retry_after)
+
+    def breaker(self, profile_id: str) -> CircuitBreaker:
+        breaker = self.breakers.get(profile_id)
+        if breaker is None:
+            breaker = self.breakers.setdefault(profile_id, CircuitBreaker())
+        return breaker
+
+    def api_retry_delay(self, profile_id: str, attempt: int, retry_after: float = None) -> float:
+        """Backoff before the next attempt, or None to give up (out of attempts, stopping, or Retry-After too long)."""
+        if attempt >= API_MAX_RETRIES or (self.monitoring and self.stop_event.is_set()):
+            return None
+        delay = backoff_delay(attempt, retry_after)
+        if delay > API_BACKOFF_MAX:
+            return None
+        self.metrics.inc("nextdns_api_retries_total", profile=profile_id or "")
+        return delay
+
+    def api_call_succeeded(self, profile_id: str):
+        if profile_id and self.breaker(profile_id).success():
+            self.print_success(f"NextDNS API recovered for {profile_id}")
+
+    def api_call_failed(self, profile_id: str, error: str, retry_after: float = None):
+        if not profile_id:
+            return
+        period = self.breaker(profile_id).failure(retry_after)
+        if period:
+            self.metrics.inc("nextdns_circuit_opens_total", profile=profile_id)
+            self.print_error(f"NextDNS API failing for {profile_id} ({error}); pausing calls for {period:.0f}s, "
+                             "keeping the last good denylist")
+
+    def telegram_session(self) -> requests.Session:
+        with self.sessions_lock:
+            if self.telegram_http is None:
+                self.telegram_http = self.new_http_session()
+            return self.telegram_http
+
+    def resize_http_pools(self, workers: int):
+        """Resize connection pools for the number of monitor workers; sessions are rebuilt lazily."""
+        with self.sessions_lock:
+            self.http_pool_size = max(HTTP_POOL_MIN_SIZE, min(HTTP_POOL_MAX_SIZE, workers))
+            for session in self.nextdns_sessions.values():
+                session.close()
+            self.nextdns_sessions.clear()
+            if self.telegram_http is not None:
+                self.telegram_http.close()
+                self.telegram_http = None
+
     # -------------------- NextDNS API helpers --------------------
-    def validate_api_key(self, api_key: str) -> Dict[str, Any]:
+    def discover_profiles(self, api_key: str) -> Dict[str, Any]:
         """
-        Validate API key and return first profile id + name.
+        List every profile the API key can access with one /profiles call
+        (plus one per further page); returns {"success", "profiles": [{"id", "name"}]}.
         """
+        profiles, params = [], {}
         try:
             self.print_info("Validating API key...")
-            headers = {"X-Api-Key": api_key}
-            resp = requests.get("https://api.nextdns.io/profiles", headers=headers, timeout=HTTP_TIMEOUT)
-            if resp.status_code != 200:
-                return {"success": False, "error": "HTTP {}".format(resp.status_code)}
-            data = resp.json()
-            profiles = data.get("data", [])
-            if not profiles:
-                return {"success": False, "error": "No profiles found"}
-            profile = profiles[0]
-            return {"success": True, "profile_id": profile.get("id"), "profile_name": profile.get("name", "")}
+            while True:
+                resp = self.nextdns_get(api_key, NEXTDNS_API_BASE + "/profiles", params=params)
+                if resp.status_code != 200:
+                    return {"success": False, "error": "HTTP {}".format(resp.status_code)}
+                data = resp.json()
+                profiles += [{"id": p["id"], "name": p.get("name", "")} for p in data.get("data", []) if p.get("id")]
+                cursor = (data.get("meta") or {}).get("pagination", {}).get("cursor")
+                if not cursor:
+                    break
+                params = {"cursor": cursor}
         except Exception as e:
             return {"success": False, "error": str(e)}
+        if not profiles:
+            return {"success": False, "error": "No profiles found"}
+        return {"success": True, "profiles": profiles}
+
+    def register_profiles(self, name: str, api_key: str, profiles: list) -> tuple:
+        """
+        Add the key's new profiles as active accounts and refresh the ones already known
+        (profile name, API key). With name=None new accounts take the profile's own name;
+        with a name, known accounts are renamed and re-activated too. Returns (added, refreshed).
+        """
+        added = refreshed = 0
+        for profile in profiles:
+            pid = profile["id"]
+            if name is None:
+                label = profile["name"] or pid
+            elif len(profiles) == 1:
+                label = name
+            else:
+                label = "{} - {}".format(name, profile["name"] or pid)
+            account = self.accounts.get(pid)
+            if account is not None:
+                account["profile_name"] = profile["name"]
+                account["api_key"] = api_key
+                if name is not None:
+                    account["name"] = label
+                    account["active"] = True
+                refreshed += 1
+                continue
+            self.accounts[pid] = {
+                "name": label,
+                "profile_name": profile["name"],
+                "api_key": api_key,
+                "added_at": datetime.now().strftime("%Y-%m-%d %I:%M:%S %p"),
+                "active": True,
+            }
+            # clear caches for this profile if any
+            self.denylist_cache.pop(pid, None)
+            added += 1
+        self.save_accounts()
+        return added, refreshed
+
+    def refresh_profiles(self) -> int:
+        """Re-discover the profiles of every saved API key, one /profiles call per key; returns how many were added."""
+        api_keys = sorted({acc.get("api_key") for acc in self.accounts.values() if acc.get("api_key")})
+        added = refreshed = 0
+        for api_key in api_keys:
+            res = self.discover_profiles(api_key)
+            if not res.get("success"):
+                self.print_error("Profile discovery failed for key ...{}: {}".format(api_key[-4:], res.get("error")))
+                continue
+            key_added, key_refreshed = self.register_profiles(None, api_key, res["profiles"])
+            added += key_added
+            refreshed += key_refreshed
+        self.print_success(f"{added} new profile(s) added, {refreshed} refreshed across {len(api_keys)} API key(s)")
+        return added
 
     def fetch_denylist(self, profile_id: str, api_key: str, force_refresh: bool = False) -> list:
         """
@@ -195,56 +2224,247 @@ class NextDNSManager:
             if profile_id in self.denylist_cache and not force_refresh:
                 return self.denylist_cache[profile_id]
 
-            headers = {"X-Api-Key": api_key}
-            url = "https://api.nextdns.io/profiles/{}/denylist".format(profile_id)
-            resp = requests.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+            url = NEXTDNS_API_BASE + "/profiles/{}/denylist".format(profile_id)
+            resp = self.nextdns_get(api_key, url, profile_id=profile_id)
             if resp.status_code != 200:
-                return []
-            data = resp.json()
-            entries = data.get("data", [])
-            domains = []
-            for e in entries:
-                # entries sometimes have 'id' which is domain
-                dom = e.get("id") or e.get("domain") or e.get("name")
-                if dom:
-                    domains.append(dom.strip().lower())
+                return self.denylist_cache.get(profile_id, [])
+            domains = self.parse_denylist(resp.json())
             # cache
             self.denylist_cache[profile_id] = domains
+            self.state_store.set_denylist(profile_id, domains)
             return domains
         except Exception:
-            return []
+            # fall back to the last good list rather than an empty one
+            return self.denylist_cache.get(profile_id, [])
+
+    @staticmethod
+    def parse_denylist(data: Dict[str, Any]) -> list:
+        domains = []
+        for e in data.get("data", []):
+            # entries sometimes have 'id' which is domain
+            dom = e.get("id") or e.get("domain") or e.get("name")
+            if dom:
+                domains.append(dom.strip().lower())
+        return domains
+
+    def refresh_denylist(self, profile_id: str, api_key: str, matcher: DenylistMatcher) -> bool:
+        """
+        Conditionally re-fetch the denylist and patch matcher in place.
+        Returns True only when the list actually changed; on failure the matcher keeps the last good list.
+        """
+        try:
+            url = NEXTDNS_API_BASE + "/profiles/{}/denylist".format(profile_id)
+            headers = {"If-None-Match": matcher.etag} if matcher.etag else {}
+            with self.tracer.span("denylist"):
+                resp = self.nextdns_get(api_key, url, profile_id=profile_id, headers=headers)
+            if resp.status_code == 304:
+                return False
+            if resp.status_code != 200:
+                self.note_poll_error(profile_id, "denylist HTTP {}".format(resp.status_code))
+                return False
+            return self.apply_denylist_body(profile_id, matcher, resp.content, resp.headers.get("ETag"))
+        except Exception as e:
+            self.note_poll_error(profile_id, "denylist: {}".format(e))
+            return False
+
+    def apply_denylist_body(self, profile_id: str, matcher: DenylistMatcher, body: bytes, etag: str = None) -> bool:
+        """Skip unchanged bodies by content hash; otherwise apply the added/removed entries."""
+        matcher.etag = etag
+        body_hash = hashlib.sha256(body).hexdigest()
+        if body_hash == matcher.source_hash:
+            return False
+        domains = self.parse_denylist(loads_json(body))
+        added, removed = matcher.update(domains)
+        matcher.source_hash = body_hash
+        self.denylist_cache[profile_id] = domains
+        self.state_store.set_denylist(profile_id, domains)
+        if added or removed:
+            self.print_info(f"Denylist for {profile_id}: +{added} / -{removed} ({len(matcher)} domains)")
+        return bool(added or removed)
+
+    def denylist_refresh_seconds(self, account: Dict[str, Any]) -> int:
+        try:
+            return max(10, int(account.get("denylist_refresh_seconds", DENYLIST_REFRESH_SECONDS)))
+        except (TypeError, ValueError):
+            return DENYLIST_REFRESH_SECONDS
 
     def fetch_logs(self, profile_id: str, api_key: str, since_seconds: int = 60) -> list:
         """
         Fetch recent logs (default last 1 minute) for a profile.
+        Returns None when the call fails, so callers can tell "no logs" from "no answer".
         """
         try:
-            headers = {"X-Api-Key": api_key}
-            url = "https://api.nextdns.io/profiles/{}/logs".format(profile_id)
+            url = NEXTDNS_API_BASE + "/profiles/{}/logs".format(profile_id)
             params = {"limit": 100, "from": int((time.time() - since_seconds) * 1000)}
-            resp = requests.get(url, headers=headers, params=params, timeout=HTTP_TIMEOUT)
+            resp = self.nextdns_get(api_key, url, profile_id=profile_id, params=params)
             if resp.status_code != 200:
-                return []
+                return None
             data = resp.json()
             return data.get("data", [])
         except Exception:
-            return []
+            return None
+
+    def fetch_new_logs(self, profile_id: str, api_key: str) -> tuple:
+        """
+        Fetch every log entry since the profile's ingestion cursor, oldest first.
+        Follows the API pagination cursor until all pages are drained, then advances
+        the cursor so each entry is counted exactly once across polls.
+        Pages are parsed as they stream in; returns (blocked records, entries ingested).
+        """
+        url = NEXTDNS_API_BASE + "/profiles/{}/logs".format(profile_id)
+        params = self.log_cursor_params(profile_id)
+        cursor = self.log_cursor(profile_id)
+        try:
+            for _ in range(MAX_LOG_PAGES_PER_POLL):
+                with self.tracer.span("fetch"):
+                    resp = self.nextdns_get(api_key, url, profile_id=profile_id, params=params, stream=True)
+                with resp:
+                    if resp.status_code != 200:
+                        self.note_poll_error(profile_id, "HTTP {}".format(resp.status_code))
+                        break
+                    # the body streams in while it is parsed, so "decode" includes reading it
+                    with self.tracer.span("decode"):
+                        data, entries = self.read_log_page(cursor, resp.iter_content(LOG_STREAM_CHUNK_SIZE))
+                self.note_stream_id(cursor, data)
+                next_cursor = (data.get("meta") or {}).get("pagination", {}).get("cursor")
+                if not entries or not next_cursor:
+                    break
+                params["cursor"] = next_cursor
+        except Exception as e:
+            self.note_poll_error(profile_id, str(e))
+        return self.commit_log_cursor(profile_id, cursor)
+
+    @staticmethod
+    def read_log_page(cursor: LogCursor, chunks) -> tuple:
+        """
+        Read one /logs body into the cursor; returns (rest of the document, entries on the page).
+        orjson decodes a whole page faster than the stdlib can stream it, so it is used when
+        installed; otherwise entries are parsed incrementally as the chunks arrive.
+        """
+        if orjson is not None:
+            data = orjson.loads(b"".join(chunks))
+            page = data.pop("data", None) or []
+            for entry in page:
+                cursor.add(entry)
+            return data, len(page)
+        stream = LogPageStream()
+        for chunk in chunks:
+            for entry in stream.feed(chunk):
+                cursor.add(entry)
+        return stream.close(), stream.count
+
+    @staticmethod
+    def note_stream_id(cursor: LogCursor, data: Dict[str, Any]):
+        """/logs pages carry the stream id matching their end, so a stream can pick up where polling stopped."""
+        stream_id = ((data.get("meta") or {}).get("stream") or {}).get("id")
+        if stream_id:
+            cursor.stream_id = stream_id
+
+    def log_cursor_params(self, profile_id: str) -> Dict[str, Any]:
+        """Query params for the first /logs page after the profile's cursor."""
+        last_ts = (self.log_cursors.get(profile_id) or {}).get("last_ts")
+        return {
+            "from": last_ts if last_ts is not None else int((time.time() - 60) * 1000),
+            "sort": "asc",
+            "limit": LOG_PAGE_LIMIT,
+        }
+
+    def log_cursor(self, profile_id: str) -> LogCursor:
+        with self.state_lock:
+            return LogCursor(self.log_cursors.get(profile_id))
+
+    def commit_log_cursor(self, profile_id: str, cursor: LogCursor) -> tuple:
+        """Persist the cursor past the entries read this poll; returns (blocked records, entries ingested)."""
+        if cursor.ingested:
+            state = cursor.state()
+            with self.state_lock:
+                self.log_cursors[profile_id] = state
+            self.state_store.set_cursor(profile_id, state)
+        return cursor.blocked, cursor.ingested
+
+    def advance_log_cursor(self, profile_id: str, logs: list) -> tuple:
+        """Run already-decoded entries through the profile's cursor (see fetch_new_logs)."""
+        cursor = self.log_cursor(profile_id)
+        for log in logs:
+            cursor.add(log)
+        return self.commit_log_cursor(profile_id, cursor)
 
     # -------------------- Telegram helpers --------------------
     def send_telegram(self, text: str, parse_mode: str = None) -> bool:
+        return self.post_telegram(text, parse_mode)[0] == 200
+
+    def post_telegram(self, text: str, parse_mode: str = None) -> tuple:
+        """
+        Send a message; returns (status, retry_after): the HTTP status, 0 when the request
+        failed or no bot is configured, and retry_after set on HTTP 429.
+        """
         token = self.bot_settings.get("bot_token")
         chat_id = self.bot_settings.get("chat_id")
         if not token or not chat_id:
-            return False
+            return 0, 0
         try:
-            url = "https://api.telegram.org/bot{}/sendMessage".format(token)
+            url = TELEGRAM_API_BASE + "/bot{}/sendMessage".format(token)
             data = {"chat_id": chat_id, "text": text}
             if parse_mode:
                 data["parse_mode"] = parse_mode
-            resp = requests.post(url, data=data, timeout=HTTP_TIMEOUT)
-            return resp.status_code == 200
+            with self.tracer.span("send"):
+                resp = self.telegram_session().post(url, data=data, timeout=HTTP_TIMEOUT)
+            if resp.status_code == 429:
+                return 429, self.telegram_retry_after(resp.json(), resp.headers.get("Retry-After"))
+            return resp.status_code, 0
         except Exception:
-            return False
+            return 0, 0
+
+    @staticmethod
+    def telegram_retry_after(body: Dict[str, Any], header: str = None) -> float:
+        try:
+            return float((body.get("parameters") or {}).get("retry_after") or header or 1)
+        except (TypeError, ValueError):
+            return 1.0
+
+    def flush_alerts(self, force: bool = False) -> int:
+        """Deliver coalesced alerts that are due; prints them locally when no bot is configured."""
+        if not (self.bot_settings.get("bot_token") and self.bot_settings.get("chat_id")):
+            for alert in self.alerts.take_due(force):
+                print("🔔 Alert (no bot): {} blocked {} x{} - {}".format(
+                    alert["account_name"], alert["domain"], alert["hits"], alert["reason"]))
+            return 0
+        return self.alerts.flush(
+            lambda text, markdown: self.post_telegram(text, parse_mode="Markdown" if markdown else None), force)
+
+    def queue_alert(self, alert: AlertEvent):
+        alert_time = datetime.now().strftime('%Y-%m-%d %I:%M:%S %p')
+        print(f"[{alert_time}] 🚨 ALERT: {alert.account_name} blocked {alert.domain}")
+        self.alert_history.add(alert)
+        self.alert_queue.put(alert)
+
+    def alert_sender(self):
+        """Sender pool thread: drain the alert queue into the dispatcher and deliver what is due."""
+        while self.alert_senders_running or len(self.alert_queue):
+            for alert in self.alert_queue.get_batch(timeout=1):
+                self.alerts.submit(alert.account_name, alert.domain, alert.reason, alert.client_ip)
+            try:
+                self.flush_alerts()  # delivered state is persisted by the periodic saver
+            except Exception as e:
+                self.print_error(f"Alert delivery error: {e}")
+
+    def start_alert_senders(self, count: int = ALERT_SENDERS):
+        if self.alert_senders_running:
+            return
+        self.alert_senders_running = True
+        self.alert_senders = [threading.Thread(target=self.alert_sender, daemon=True) for _ in range(count)]
+        for t in self.alert_senders:
+            t.start()
+
+    def stop_alert_senders(self):
+        """Drain queued alerts, then deliver everything still pending in the dispatcher."""
+        self.alert_senders_running = False
+        for t in self.alert_senders:
+            t.join(timeout=HTTP_TIMEOUT * 2)
+        self.alert_senders = []
+        for alert in self.alert_queue.unspill():
+            self.alerts.submit(alert.account_name, alert.domain, alert.reason, alert.client_ip)
+        self.flush_alerts(force=True)
 
     def send_telegram_alert(self, account_name: str, domain: str, reason: str, client_ip: str = "") -> bool:
         token = self.bot_settings.get("bot_token")
@@ -254,17 +2474,29 @@ class NextDNSManager:
             print("🔔 Alert (no bot): {} blocked {} - {}".format(account_name, domain, reason))
             return False
         try:
-            message = "🚨 *NextDNS Alert*\n\n"
-            message += "• *Account*: {}\n".format(account_name)
-            message += "• *Domain*: `{}`\n".format(domain)
-            message += "• *Reason*: {}\n".format(reason)
-            if client_ip:
-                message += "• *Client IP*: `{}`\n".format(client_ip)
-            message += "• *Time*: {}".format(datetime.now().strftime('%Y-%m-%d %I:%M:%S %p'))
-            return self.send_telegram(message, parse_mode="Markdown")
+            return self.send_telegram(self.format_alert(account_name, domain, reason, client_ip), parse_mode="Markdown")
         except Exception:
             return False
 
+    @staticmethod
+    def format_alert(account_name: str, domain: str, reason: str, client_ip: str = "", hits: int = 1,
+                     markdown: bool = True) -> str:
+        """Alert text for Telegram's Markdown parse mode, or plain text with markdown=False."""
+        if markdown:
+            bold, code, escape = "*{}*".format, "`{}`".format, escape_markdown
+        else:
+            bold = code = escape = str
+        message = "🚨 {}\n\n".format(bold("NextDNS Alert"))
+        message += "• {}: {}\n".format(bold("Account"), escape(account_name))
+        message += "• {}: {}\n".format(bold("Domain"), code(domain))
+        message += "• {}: {}\n".format(bold("Reason"), escape(reason))
+        if client_ip:
+            message += "• {}: {}\n".format(bold("Client IP"), code(client_ip))
+        if hits > 1:
+            message += "• {}: {}\n".format(bold("Hits"), hits)
+        message += "• {}: {}".format(bold("Time"), datetime.now().strftime('%Y-%m-%d %I:%M:%S %p'))
+        return message
+
     # -------------------- Account management --------------------
     def add_account(self):
         self.print_header("Add New Account")
@@ -284,30 +2516,24 @@ class NextDNSManager:
             self.wait_for_enter()
             return
             
-        self.print_info("Validating API Key...")
-        res = self.validate_api_key(api_key)
+        # one /profiles call registers every profile behind the key
+        res = self.discover_profiles(api_key)
         if not res.get("success"):
             self.print_error("Failed to validate API Key: {}".format(res.get('error')))
             self.wait_for_enter()
             return
             
-        profile_id = res["profile_id"]
-        profile_name = res.get("profile_name", "")
-        
-        self.accounts[profile_id] = {
-            "name": name,
-            "profile_name": profile_name,
-            "api_key": api_key,
-            "added_at": datetime.now().strftime("%Y-%m-%d %I:%M:%S %p"),
-            "active": True,
-        }
-        
-        # clear caches for this profile if any
-        if profile_id in self.denylist_cache:
-            del self.denylist_cache[profile_id]
-            
-        self.save_accounts()
-        self.print_success("Account '{}' added with profile {}".format(name, profile_id))
+        profiles = res["profiles"]
+        profile_id = profiles[0]["id"]
+        added, refreshed = self.register_profiles(name, api_key, profiles)
+        if len(profiles) == 1:
+            self.print_success("Account '{}' {} with profile {}".format(
+                name, "added" if added else "updated and re-activated", profile_id))
+        else:
+            for profile in profiles:
+                print(f"   • {self.accounts[profile['id']].get('name')} (Profile {profile['id']})")
+            self.print_success(f"{len(profiles)} profiles found: {added} added, "
+                               f"{refreshed} already saved (renamed and re-activated)")
         
         # offer test alert
         if self.bot_settings.get("bot_token") and self.bot_settings.get("chat_id"):
@@ -375,12 +2601,14 @@ class NextDNSManager:
             print(f"🏷️  Profile name: {account.get('profile_name','N/A')}")
             print(f"📊 Status: {'🟢 Active' if account.get('active', False) else '🔴 Inactive'}")
             print(f"⏰ Added: {account.get('added_at','N/A')}")
+            print(f"⏱️  Denylist refresh: every {self.denylist_refresh_seconds(account)}s")
             print()
             print("🔧 Management Options:")
             print("1. 🔄 Toggle Enable/Disable")
             print("2. 📤 Send Test Alert to Telegram")
             print("3. 🗑️  Delete Account")
-            print("4. ↩️  Back to Main Menu")
+            print("4. ⏱️  Set Denylist Refresh Interval")
+            print("5. ↩️  Back to Main Menu")
             
             sub = input("\n🎯 Choose option: ").strip()
             if sub == "1":
@@ -400,10 +2628,7 @@ class NextDNSManager:
                 confirm = input("❓ Are you sure you want to delete this account? (y/n): ").strip().lower()
                 if confirm == "y":
                     # remove caches
-                    if profile_id in self.denylist_cache:
-                        del self.denylist_cache[profile_id]
-                    if profile_id in self.processed_requests:
-                        del self.processed_requests[profile_id]
+                    self.forget_profile_state(profile_id)
                     del self.accounts[profile_id]
                     self.save_accounts()
                     self.save_state()
@@ -411,6 +2636,17 @@ class NextDNSManager:
                     self.wait_for_enter()
                     break
             elif sub == "4":
+                try:
+                    seconds = int(input("⏱️  Refresh denylist every N seconds (min 10): ").strip())
+                except ValueError:
+                    self.print_error("Invalid input")
+                    self.wait_for_enter()
+                    continue
+                account["denylist_refresh_seconds"] = max(10, seconds)
+                self.save_accounts()
+                self.print_success(f"Denylist refresh set to every {account['denylist_refresh_seconds']}s")
+                self.wait_for_enter()
+            elif sub == "5":
                 break
             else:
                 self.print_error("Invalid option")
@@ -474,10 +2710,7 @@ class NextDNSManager:
         
         confirm = input(f"❓ Confirm delete account '{name}'? (y/n): ").strip().lower()
         if confirm == "y":
-            if profile_id in self.denylist_cache:
-                del self.denylist_cache[profile_id]
-            if profile_id in self.processed_requests:
-                del self.processed_requests[profile_id]
+            self.forget_profile_state(profile_id)
             del self.accounts[profile_id]
             self.save_accounts()
             self.save_state()
@@ -539,6 +2772,58 @@ class NextDNSManager:
         return self.send_telegram_alert(acc.get("name", "Account"), "test.example.com", "Test alert from account")
 
     # -------------------- Dashboard --------------------
+    def update_snapshot(self, profile_id: str, **stats):
+        with self.snapshot_lock:
+            snapshot = self.snapshots.setdefault(profile_id, {})
+            snapshot.update(stats)
+            snapshot["updated_at"] = time.time()
+
+    def feed_snapshot(self, profile_id: str, denylist_size: int, custom_blocks: int):
+        """Called by the monitor engines after every poll, so the dashboard needs no API calls of its own."""
+        now = time.time()
+        with self.snapshot_lock:
+            history = self.block_history.setdefault(profile_id, deque())
+            history.append((now, custom_blocks))
+            while history and now - history[0][0] > RECENT_BLOCKS_WINDOW:
+                history.popleft()
+            recent_blocks = sum(n for _, n in history)
+        self.update_snapshot(profile_id, denylist_size=denylist_size, recent_blocks=recent_blocks)
+
+    def fetch_snapshot(self, profile_id: str, account: Dict[str, Any]):
+        try:
+            api_key = account.get("api_key", "")
+            denylist = DenylistMatcher(self.fetch_denylist(profile_id, api_key))
+            recent_logs = self.fetch_logs(profile_id, api_key, since_seconds=RECENT_BLOCKS_WINDOW)
+            if recent_logs is None:
+                return  # keep the previous snapshot; it shows its age
+            names = [l.get("name") or l.get("domain") or "" for l in recent_logs
+                     if l.get("status") == 2 or l.get("status") == "blocked"]
+            self.update_snapshot(profile_id, denylist_size=len(denylist), recent_blocks=sum(denylist.match_many(names)))
+        finally:
+            with self.snapshot_lock:
+                self.snapshot_refreshing.discard(profile_id)
+
+    def refresh_snapshots(self):
+        """Re-fetch stale profile snapshots in the background, all profiles concurrently."""
+        now = time.time()
+        for pid, acc in list(self.accounts.items()):
+            with self.snapshot_lock:
+                snapshot = self.snapshots.get(pid)
+                if pid in self.snapshot_refreshing:
+                    continue
+                if snapshot and now - snapshot["updated_at"] < DASHBOARD_SNAPSHOT_TTL:
+                    continue
+                self.snapshot_refreshing.add(pid)
+            self.snapshot_pool.submit(self.fetch_snapshot, pid, acc)
+
+    @staticmethod
+    def snapshot_age(snapshot: Dict[str, Any]) -> str:
+        if not snapshot:
+            return "⏳ loading"
+        age = int(time.time() - snapshot["updated_at"])
+        label = f"{age}s ago" if age < 120 else f"{age // 60}m ago"
+        return label + (" (stale)" if age >= DASHBOARD_SNAPSHOT_TTL else "")
+
     def show_dashboard(self):
         self.clear_screen()
         now = datetime.now().strftime("%Y-%m-%d %I:%M:%S %p")
@@ -561,6 +2846,9 @@ class NextDNSManager:
             print("╚" + "═" * 78 + "╝")
             return
             
+        # Render from the last snapshots right away; stale ones refresh in the background
+        self.refresh_snapshots()
+        
         print("║ {:<78} ║".format("📋 Account Details:"))
         print("╠" + "─" * 78 + "╣")
         
@@ -568,138 +2856,468 @@ class NextDNSManager:
             name = acc.get("name", "N/A")
             status = "🟢 Active" if acc.get("active", False) else "🔴 Inactive"
             profile_name = acc.get("profile_name", "N/A")
-            denylist = self.fetch_denylist(pid, acc.get("api_key", ""))
-            recent_logs = self.fetch_logs(pid, acc.get("api_key", ""))
-            recent_custom_blocks = [l for l in recent_logs if l.get("action") == "blocked" and l.get("domain") in denylist]
+            with self.snapshot_lock:
+                snapshot = dict(self.snapshots.get(pid) or {})
+            denylist_size = snapshot.get("denylist_size", "-")
+            recent_blocks = snapshot.get("recent_blocks", "-")
             
             print(f"║ {i}. {name:<20} {status:<15} ║")
             print(f"║    📍 Profile: {profile_name:<64} ║")
-            print(f"║    📊 Denylist: {len(denylist):<3} domains | Recent blocks: {len(recent_custom_blocks):<3} ║")
+            print(f"║    📊 Denylist: {denylist_size:<3} domains | Recent blocks: {recent_blocks:<3} | 🕐 {self.snapshot_age(snapshot)} ║")
+            traffic = self.analytics.summary(pid, ANALYTICS_WINDOWS["1h"], top=1)
+            if traffic:
+                day_blocked, _ = self.analytics.counts(pid, ANALYTICS_WINDOWS["24h"])
+                top = traffic["top_domains"][0] if traffic["top_domains"] else ["-", 0, 0]
+                print(f"║    📈 Blocked 1h: {traffic['blocked']} | 24h: {day_blocked} | "
+                      f"Denylist hits 1h: {traffic['denylist_matches']} | Top: {top[0]} ({top[1]}) ║")
             print("║" + " " * 78 + "║")
             
         print("╚" + "═" * 78 + "╝")
 
     # -------------------- Monitoring --------------------
-    def is_domain_in_denylist(self, domain: str, denylist: set) -> bool:
+    def collect_alerts(self, profile_id: str, acc_name: str, blocked: list, denylist: DenylistMatcher,
+                       ingested: int = 0) -> list:
         """
-        Check if domain matches any entry in denylist.
-        Supports exact match and wildcard patterns (*.example.com)
+        Narrow a poll's blocked LogRecords down to new custom-denylist blocks, record them
+        as processed and return them as AlertEvents.
+        Shared by every monitoring engine so alert semantics stay identical.
         """
-        domain = domain.lower().strip()
+        if ingested > 0:
+            current_time = datetime.now().strftime('%H:%M:%S')
+            print(f"[{current_time}] 📡 {acc_name}: Checked {ingested} logs, {len(blocked)} blocked")
         
-        # Exact match
-        if domain in denylist:
-            return True
+        # Match the whole page against the denylist in one pass
+        with self.tracer.span("match"):
+            names = [record.domain for record in blocked]
+            hits = denylist.match_many(names)
         
-        # Check wildcard patterns (*.example.com should match sub.example.com)
-        for denylist_entry in denylist:
-            if denylist_entry.startswith("*."):
-                # Remove *. and check if domain ends with the pattern
-                pattern = denylist_entry[2:]  # Remove *.
-                if domain.endswith(pattern) or domain.endswith("." + pattern):
-                    return True
-            # Check if domain is subdomain of denylist entry
-            elif "." in domain:
-                parts = domain.split(".")
-                for i in range(len(parts)):
-                    parent = ".".join(parts[i:])
-                    if parent in denylist:
-                        return True
+        dedupe = self.dedupe_cache(profile_id)
+        account_name = acc_name or "Account"
+        alerts, new_keys = [], []
+        now = time.time()
+        with self.tracer.span("dedupe"):
+            with self.state_lock:
+                for record, hit in zip(blocked, hits):
+                    if not hit:
+                        continue
+                    
+                    # Skip if this request was already processed, otherwise record it
+                    key = DedupeCache.key("{}_{}".format(record.domain, record.timestamp))
+                    if not dedupe.add(key, now):
+                        continue
+                    new_keys.append((key, now))
+                    alerts.append(AlertEvent(account_name, record.domain, record.client_ip, record.device,
+                                             profile_id, record.timestamp))
+            if new_keys:
+                self.state_store.add_processed(profile_id, new_keys)
         
-        return False
-
-    def monitor_worker(self, profile_id: str, account: Dict[str, Any]):
-        """
-        Thread worker that monitors logs for a single account/profile and sends alerts only
-        when domain is in custom denylist.
-        """
-        if profile_id not in self.processed_requests:
-            self.processed_requests[profile_id] = set()
+        matches = sum(hits)
+        self.metrics.inc("nextdns_matches_total", matches, profile=profile_id)
+        self.feed_snapshot(profile_id, len(denylist), matches)
+        self.analytics.add(profile_id, blocked, hits)
+        
+        # Limit memory usage: drop ids past the TTL / size cap, oldest first
+        with self.state_lock:
+            evicted = dedupe.expire()
+        if evicted:
+            self.state_store.remove_processed(profile_id, evicted)
         
+        return alerts
+
+    def dedupe_cache(self, profile_id: str) -> DedupeCache:
+        with self.state_lock:
+            cache = self.processed_requests.get(profile_id)
+            if cache is None:
+                cache = self.processed_requests[profile_id] = DedupeCache()
+            return cache
+
+    def start_profile(self, profile_id: str, account: Dict[str, Any]) -> Dict[str, Any]:
+        """Per-profile poll state: the compiled denylist, its refresh deadline and the adaptive interval."""
+        self.dedupe_cache(profile_id)
         acc_name = account.get('name')
         self.print_info(f"Started monitoring: {acc_name} (Profile: {profile_id})")
-        
-        # Load denylist
-        denylist_raw = self.fetch_denylist(profile_id, account.get("api_key", ""), force_refresh=True)
-        denylist = set(d.lower().strip() for d in denylist_raw)
-        self.print_info(f"Loaded {len(denylist)} domains in denylist")
-        
-        check_interval = 10  # Check every 10 seconds
-        iteration = 0
-        
-        while account.get("active", False) and self.monitoring:
+        self.register_worker(profile_id, acc_name)
+        poll = {
+            "profile_id": profile_id,
+            "account": account,
+            # start from the last good list so an API outage at startup doesn't disable matching
+            "denylist": DenylistMatcher(self.denylist_cache.get(profile_id, [])),
+            "next_refresh": 0.0,  # refresh the denylist on the first poll
+            "interval": CHECK_INTERVAL,
+        }
+        self.polls[profile_id] = poll
+        return poll
+
+    def next_poll_interval(self, poll: Dict[str, Any], ingested: int, alerted: int) -> float:
+        """Poll busy profiles faster and back off exponentially on idle ones."""
+        interval = poll["interval"]
+        if ingested >= LOG_PAGE_LIMIT:
+            # a full page means there is still a backlog to drain
+            interval = MIN_POLL_INTERVAL
+        elif alerted or ingested >= BUSY_LOGS_PER_POLL:
+            interval = max(MIN_POLL_INTERVAL, interval / 2)
+        elif not ingested:
+            interval = min(MAX_POLL_INTERVAL, interval * 1.5)
+        else:
+            interval = (interval + CHECK_INTERVAL) / 2
+        poll["interval"] = interval
+        status = self.worker_status.get(poll["profile_id"])
+        if status is not None:
+            status["interval"] = round(interval, 2)
+        return interval
+
+    def poll_profile(self, profile_id: str):
+        """
+        One poll of one profile for the thread engine: refresh the denylist when due,
+        ingest new logs and queue alerts. Returns the delay until the next poll,
+        or None once the account is disabled or monitoring stops.
+        """
+        poll = self.polls[profile_id]
+        account = poll["account"]
+        if not (account.get("active", False) and self.monitoring):
+            return None
+        api_key = account.get("api_key", "")
+        retry_in = self.breaker(profile_id).retry_in()
+        if retry_in:
+            return retry_in
+        # a no-op unless a --trace-sample / /trace sample of this profile is pending
+        with self.tracer.sampling(profile_id):
             try:
-                iteration += 1
+                # Refresh denylist (every 5 minutes unless the account overrides it)
+                if time.time() >= poll["next_refresh"]:
+                    self.refresh_denylist(profile_id, api_key, poll["denylist"])
+                    poll["next_refresh"] = time.time() + self.denylist_refresh_seconds(account)
                 
-                # Refresh denylist every 5 minutes (30 iterations)
-                if iteration % 30 == 0:
-                    denylist_raw = self.fetch_denylist(profile_id, account.get("api_key", ""), force_refresh=True)
-                    denylist = set(d.lower().strip() for d in denylist_raw)
-                    self.print_info(f"Refreshed denylist: {len(denylist)} domains")
+                # Fetch every log entry since the last poll
+                started = time.time()
+                blocked, ingested = self.fetch_new_logs(profile_id, api_key)
                 
-                # Fetch logs from last minute
-                logs = self.fetch_logs(profile_id, account.get("api_key", ""), since_seconds=60)
+                # Hand alerts to the sender pool; delivery never delays the next poll
+                alerts = self.collect_alerts(profile_id, account.get('name'), blocked, poll["denylist"], ingested)
+                for alert in alerts:
+                    self.queue_alert(alert)
+                self.record_poll(profile_id, started, ingested)
                 
-                blocked_logs = [l for l in logs if l.get("status") == 2 or l.get("status") == "blocked"]
+                # a Retry-After / open breaker from this poll outranks the adaptive interval
+                return max(self.next_poll_interval(poll, ingested, len(alerts)), self.breaker(profile_id).retry_in())
                 
-                if len(logs) > 0:
-                    current_time = datetime.now().strftime('%H:%M:%S')
-                    print(f"[{current_time}] 📡 {acc_name}: Checked {len(logs)} logs, {len(blocked_logs)} blocked")
+            except Exception as e:
+                self.print_error(f"Monitor error for {profile_id}: {str(e)}")
+                self.note_poll_error(profile_id, str(e))
+                import traceback
+                traceback.print_exc()
+                return 10
+
+    def save_state_periodically(self):
+        while not self.stop_event.wait(STATE_SAVE_INTERVAL):
+            self.save_state()
+
+    # -------------------- Stream engine --------------------
+    def stream_worker(self, profile_id: str, account: Dict[str, Any]):
+        """
+        Stream engine: hold one SSE connection to /logs/stream for the profile and feed
+        each event straight into the match / dedupe / alert path. Reconnects resume from
+        the last event id; after repeated failures the profile falls back to polling for a while.
+        """
+        poll = self.start_profile(profile_id, account)
+        failures, poll_until = 0, 0.0
+        while account.get("active", False) and self.monitoring:
+            if time.time() < poll_until or not (self.log_cursors.get(profile_id) or {}).get("stream_id"):
+                # polling fallback; a poll also catches up and yields the id to stream from
+                delay = self.poll_profile(profile_id)
+                if delay is None:
+                    break
+                if time.time() < poll_until:
+                    self.stop_event.wait(delay)
+                    continue
+            retry_in = self.breaker(profile_id).retry_in()
+            if retry_in:
+                self.stop_event.wait(retry_in)
+                continue
+            opened = time.time()
+            try:
+                self.stream_logs(poll)
+                failures = 0
+                # a stream the server closes right away must not turn into a reconnect loop
+                self.stop_event.wait(STREAM_RECONNECT_SECONDS - (time.time() - opened))
+            except Exception as e:
+                if not self.monitoring:
+                    break
+                if is_read_timeout(e):
+                    failures = 0  # a quiet stream: reconnect as after a clean close
+                    continue
+                failures += 1
+                if failures >= STREAM_MAX_FAILURES:
+                    self.print_warning(f"Log stream for {profile_id} keeps failing ({e}); "
+                                       f"polling for {STREAM_RETRY_SECONDS}s")
+                    failures, poll_until = 0, time.time() + STREAM_RETRY_SECONDS
+                else:
+                    self.stop_event.wait(max(backoff_delay(failures), self.breaker(profile_id).retry_in()))
+
+    def stream_logs(self, poll: Dict[str, Any]):
+        """
+        Read one stream connection until it closes, goes quiet for STREAM_READ_TIMEOUT,
+        monitoring stops or the denylist is due for a refresh. Raises on HTTP / connection errors.
+        """
+        profile_id, account = poll["profile_id"], poll["account"]
+        api_key = account.get("api_key", "")
+        url = NEXTDNS_API_BASE + "/profiles/{}/logs/stream".format(profile_id)
+        cursor = self.log_cursor(profile_id)
+        committed = time.time()
+        try:
+            if time.time() >= poll["next_refresh"]:
+                self.refresh_denylist(profile_id, api_key, poll["denylist"])
+                poll["next_refresh"] = time.time() + self.denylist_refresh_seconds(account)
+            headers = {"Accept": "text/event-stream", "Last-Event-ID": cursor.stream_id}
+            with self.tracer.span("fetch"):
+                resp = self.nextdns_get(api_key, url, profile_id=profile_id, params={"id": cursor.stream_id},
+                                        headers=headers, stream=True, timeout=(HTTP_TIMEOUT, STREAM_READ_TIMEOUT))
+            poll["stream"] = resp
+            with resp:
+                if resp.status_code != 200:
+                    raise NextDNSAPIError("HTTP {}".format(resp.status_code), resp.status_code)
+                resp.encoding = "utf-8"
+                for event_id, data in iter_sse_events(resp.iter_lines(chunk_size=None, decode_unicode=True)):
+                    now = time.time()
+                    if data:
+                        with self.tracer.sampling(profile_id):
+                            with self.tracer.span("decode"):
+                                cursor.add(loads_json(data))
+                            cursor.stream_id = event_id or cursor.stream_id
+                            if cursor.blocked:
+                                for alert in self.collect_alerts(profile_id, account.get('name'), cursor.blocked,
+                                                                 poll["denylist"]):
+                                    self.queue_alert(alert)
+                                cursor.blocked = []
+                    if now - committed >= STREAM_COMMIT_SECONDS:
+                        self.commit_stream_cursor(profile_id, cursor, committed)
+                        committed = now
+                    else:
+                        self.touch_worker(profile_id)
+                    if not (account.get("active", False) and self.monitoring) or now >= poll["next_refresh"]:
+                        break
+        except Exception as e:
+            # noted before the final commit, so that "poll" counts as failed
+            if self.monitoring and not is_read_timeout(e):
+                self.note_poll_error(profile_id, "stream: {}".format(e))
+            raise
+        finally:
+            poll["stream"] = None
+            self.commit_stream_cursor(profile_id, cursor, committed)
+
+    def commit_stream_cursor(self, profile_id: str, cursor: LogCursor, started: float):
+        """Persist the stream's progress and record the span since the last commit as one poll."""
+        _, ingested = self.commit_log_cursor(profile_id, cursor)
+        cursor.ingested = 0
+        self.record_poll(profile_id, started, ingested)
+
+    def touch_worker(self, profile_id: str):
+        """A stream is alive while events or keep-alives arrive."""
+        status = self.worker_status.get(profile_id)
+        if status is not None:
+            status["last_poll"] = time.time()
+
+    # -------------------- Async engine --------------------
+    async def async_nextdns_get(self, session, limiter: asyncio.Semaphore, url: str, api_key: str, profile_id: str,
+                                headers: Dict[str, str] = None, params: Dict[str, Any] = None) -> tuple:
+        """Async counterpart of nextdns_get; returns (status, body, headers) or raises NextDNSAPIError."""
+        breaker = self.breaker(profile_id)
+        if not breaker.allow():
+            raise CircuitOpenError("circuit open, retry in {:.0f}s".format(breaker.retry_in()))
+        headers = dict(headers or {}, **{"X-Api-Key": api_key})
+        for attempt in range(API_MAX_RETRIES + 1):
+            await asyncio.sleep(self.request_delay(api_key))
+            status, retry_after = None, None
+            try:
+                async with limiter:
+                    async with session.get(url, headers=headers, params=params) as resp:
+                        if resp.status not in RETRYABLE_STATUSES:
+                            body = await resp.read()
+                            self.api_call_succeeded(profile_id)
+                            return resp.status, body, resp.headers
+                        status, retry_after = resp.status, parse_retry_after(resp.headers.get("Retry-After"))
+                        error = "HTTP {}".format(status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+            delay = self.api_retry_delay(profile_id, attempt, retry_after)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+        self.api_call_failed(profile_id, error, retry_after)
+        raise NextDNSAPIError(error, status, retry_after)
+
+    async def async_refresh_denylist(self, session, limiter: asyncio.Semaphore, profile_id: str, api_key: str,
+                                     matcher: DenylistMatcher) -> bool:
+        """Async counterpart of refresh_denylist."""
+        url = NEXTDNS_API_BASE + "/profiles/{}/denylist".format(profile_id)
+        headers = {"If-None-Match": matcher.etag} if matcher.etag else {}
+        try:
+            with self.tracer.span("denylist"):
+                status, body, resp_headers = await self.async_nextdns_get(session, limiter, url, api_key, profile_id,
+                                                                          headers)
+            if status == 304:
+                return False
+            if status != 200:
+                self.note_poll_error(profile_id, "denylist HTTP {}".format(status))
+                return False
+            return self.apply_denylist_body(profile_id, matcher, body, resp_headers.get("ETag"))
+        except Exception as e:
+            self.note_poll_error(profile_id, "denylist: {}".format(e))
+            return False
+
+    async def async_fetch_new_logs(self, session, limiter: asyncio.Semaphore, profile_id: str, api_key: str) -> tuple:
+        """Async counterpart of fetch_new_logs sharing the same cursor handling and page parser."""
+        url = NEXTDNS_API_BASE + "/profiles/{}/logs".format(profile_id)
+        params = self.log_cursor_params(profile_id)
+        cursor = self.log_cursor(profile_id)
+        try:
+            for _ in range(MAX_LOG_PAGES_PER_POLL):
+                with self.tracer.span("fetch"):
+                    status, body, _ = await self.async_nextdns_get(session, limiter, url, api_key, profile_id,
+                                                                   params=params)
+                if status != 200:
+                    self.note_poll_error(profile_id, "HTTP {}".format(status))
+                    break
+                with self.tracer.span("decode"):
+                    data, entries = self.read_log_page(cursor, (body,))
+                self.note_stream_id(cursor, data)
+                next_cursor = (data.get("meta") or {}).get("pagination", {}).get("cursor")
+                if not entries or not next_cursor:
+                    break
+                params["cursor"] = next_cursor
+        except Exception as e:
+            self.note_poll_error(profile_id, str(e) or type(e).__name__)
+        return self.commit_log_cursor(profile_id, cursor)
+
+    async def async_monitor_worker(self, session, limiter: asyncio.Semaphore, profile_id: str, account: Dict[str, Any]):
+        """
+        Coroutine counterpart of poll_profile: same poll / match / alert steps and the same
+        adaptive interval, but HTTP goes through the shared aiohttp session and waits don't hold a thread.
+        """
+        poll = self.start_profile(profile_id, account)
+        api_key = account.get("api_key", "")
+        
+        while account.get("active", False) and self.monitoring:
+            retry_in = self.breaker(profile_id).retry_in()
+            if retry_in:
+                await asyncio.sleep(retry_in)
+                continue
+            try:
+                if time.time() >= poll["next_refresh"]:
+                    await self.async_refresh_denylist(session, limiter, profile_id, api_key, poll["denylist"])
+                    poll["next_refresh"] = time.time() + self.denylist_refresh_seconds(account)
                 
-                for log in blocked_logs:
-                    domain = (log.get("name") or log.get("domain") or "").lower().strip()
+                # a sample here profiles everything the event loop runs while this poll awaits
+                with self.tracer.sampling(profile_id):
+                    started = time.time()
+                    blocked, ingested = await self.async_fetch_new_logs(session, limiter, profile_id, api_key)
                     
-                    if not domain:
-                        continue
-                    
-                    # Check if domain is in denylist
-                    if not self.is_domain_in_denylist(domain, denylist):
-                        continue
-                    
-                    # Create unique ID for this request
-                    timestamp = log.get("timestamp", int(time.time() * 1000))
-                    req_id = "{}_{}".format(domain, timestamp)
-                    
-                    # Skip if already processed
-                    if req_id in self.processed_requests.get(profile_id, set()):
-                        continue
-                    
-                    # Record this alert
-                    self.processed_requests.setdefault(profile_id, set()).add(req_id)
-                    
-                    # Extract client info
-                    client_ip = log.get("clientIp") or log.get("device", {}).get("id", "") or ""
-                    device_name = log.get("device", {}).get("name", "")
-                    reason = "Blocked by custom denylist"
-                    if device_name:
-                        reason += f" (Device: {device_name})"
-                    
-                    # Send alert
-                    alert_time = datetime.now().strftime('%Y-%m-%d %I:%M:%S %p')
-                    print(f"[{alert_time}] 🚨 ALERT: {acc_name} blocked {domain}")
-                    self.send_telegram_alert(account.get("name", "Account"), domain, reason, client_ip)
-                    
-                    # Save state immediately after sending alert
-                    self.save_state()
-                    
-                    # Limit memory usage
-                    if len(self.processed_requests[profile_id]) > 2000:
-                        self.processed_requests[profile_id] = set(list(self.processed_requests[profile_id])[-1000:])
-                
-                # Save state periodically
-                if iteration % 6 == 0:  # Every minute
-                    self.save_state()
+                    alerts = self.collect_alerts(profile_id, account.get('name'), blocked, poll["denylist"], ingested)
+                    for alert in alerts:
+                        if self.alert_queue.policy == "block":
+                            await asyncio.to_thread(self.queue_alert, alert)
+                        else:
+                            self.queue_alert(alert)
+                    self.record_poll(profile_id, started, ingested)
                 
-                time.sleep(check_interval)
+                await asyncio.sleep(max(self.next_poll_interval(poll, ingested, len(alerts)),
+                                        self.breaker(profile_id).retry_in()))
                 
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 self.print_error(f"Monitor error for {profile_id}: {str(e)}")
+                self.note_poll_error(profile_id, str(e))
                 import traceback
                 traceback.print_exc()
-                time.sleep(10)
+                await asyncio.sleep(10)
+
+    async def run_async_monitoring(self):
+        """Run every active profile as a coroutine on one event loop with one shared HTTP client."""
+        self.async_loop = asyncio.get_running_loop()
+        self.async_task = asyncio.current_task()
+        limiter = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+        connector = aiohttp.TCPConnector(limit=ASYNC_MAX_CONCURRENCY, limit_per_host=HTTP_POOL_MAX_SIZE)
+        timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                workers = [
+                    self.async_monitor_worker(session, limiter, pid, acc)
+                    for pid, acc in self.monitored_accounts().items()
+                ]
+                await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            pass
+
+    def owns_profile(self, profile_id: str) -> bool:
+        """A saved account that this process monitors (its shard's, when sharded)."""
+        return profile_id in self.accounts and (
+            self.shard_ring is None or self.shard_ring.shard_for(profile_id) == self.shard[0])
+
+    def monitored_accounts(self) -> Dict[str, Dict[str, Any]]:
+        """Active accounts, limited to this process's shard when sharded."""
+        return {pid: acc for pid, acc in self.accounts.items() if acc.get("active", False) and self.owns_profile(pid)}
+
+    def start_monitor_engine(self) -> int:
+        """Start monitoring every active account in the background; returns the number of profiles."""
+        active = self.monitored_accounts()
+        if not active or self.monitoring:
+            return 0
+        
+        self.monitoring = True
+        self.stop_event.clear()
+        workers = min(SCHEDULER_MAX_WORKERS, len(active))
+        self.resize_http_pools(len(active) if self.engine == "async" else workers)
+        self.start_alert_senders()
+        self.alert_history.start()
+        self.state_saver = threading.Thread(target=self.save_state_periodically, daemon=True)
+        self.state_saver.start()
+        
+        if self.engine == "async":
+            self.async_thread = threading.Thread(target=asyncio.run, args=(self.run_async_monitoring(),), daemon=True)
+            self.async_thread.start()
+        elif self.engine == "stream":
+            for pid, acc in active.items():
+                t = threading.Thread(target=self.stream_worker, args=(pid, acc), daemon=True)
+                self.stream_threads.append(t)
+                t.start()
+        else:
+            self.scheduler = PollScheduler(self.poll_profile, workers, self.stop_event)
+            for pid, acc in active.items():
+                self.start_profile(pid, acc)
+                self.scheduler.schedule(pid)
+            self.scheduler.start()
+        return len(active)
+
+    def stop_monitor_engine(self):
+        """Stop polling, drain queued alerts and flush state."""
+        self.monitoring = False
+        self.stop_event.set()
+        if self.async_loop is not None and self.async_task is not None:
+            self.async_loop.call_soon_threadsafe(self.async_task.cancel)
+        if self.async_thread is not None:
+            self.async_thread.join(timeout=HTTP_TIMEOUT + 2)
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        for poll in list(self.polls.values()):
+            if poll.get("stream") is not None:
+                poll["stream"].close()  # unblocks the reader
+        for t in self.stream_threads:
+            t.join(timeout=HTTP_TIMEOUT + 2)
+        self.stream_threads = []
+        if self.state_saver is not None:
+            self.state_saver.join(timeout=2)
+        self.async_thread = self.async_loop = self.async_task = None
+        self.scheduler = self.state_saver = None
+        self.polls.clear()
+        self.stop_alert_senders()
+        self.alert_history.stop()
+        self.save_state()
+        if self.tracer.enabled:
+            self.tracer.dump()
 
     def start_live_monitoring(self):
-        # start threaded monitoring for all active accounts
+        # start monitoring for all active accounts
         active_accounts = [acc for acc in self.accounts.values() if acc.get("active", False)]
         if not active_accounts:
             self.print_error("No active accounts to monitor")
@@ -711,32 +3329,160 @@ class NextDNSManager:
             self.wait_for_enter()
             return
             
-        self.monitoring = True
-        threads = []
-        
+        if self.engine == "async" and aiohttp is None:
+            self.print_error("The async engine needs aiohttp (pip install aiohttp)")
+            self.wait_for_enter()
+            return
+            
         self.print_header("Starting Live Monitoring")
-        print(f"🔍 Starting monitoring for {len(active_accounts)} active account(s)")
+        print(f"🔍 Starting monitoring for {len(active_accounts)} active account(s) [{self.engine} engine]")
         print("📝 Press Ctrl+C to stop monitoring")
         print()
         
-        for pid, acc in self.accounts.items():
-            if acc.get("active", False):
-                t = threading.Thread(target=self.monitor_worker, args=(pid, acc), daemon=True)
-                threads.append(t)
-                t.start()
-                
         try:
+            self.start_monitor_engine()
             while self.monitoring:
                 time.sleep(1)
         except KeyboardInterrupt:
             print("\n🛑 Stopping monitoring...")
-            self.monitoring = False
-            # wait briefly for threads to finish gracefully
-            time.sleep(2)
-            self.save_state()
+            self.stop_monitor_engine()
             self.print_success("Monitoring stopped and state saved")
             self.wait_for_enter()
 
+    def serve(self):
+        """
+        Headless service mode: monitor every active account until SIGTERM / Ctrl+C,
+        then drain alerts and flush state.
+        """
+        if self.engine == "async" and aiohttp is None:
+            self.print_error("The async engine needs aiohttp (pip install aiohttp)")
+            return 1
+        
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop_event.set())
+        
+        count = self.start_monitor_engine()
+        if not count:
+            self.print_warning("No active accounts to monitor; serving status endpoints only")
+        else:
+            self.print_info(f"Monitoring {count} active account(s) [{self.engine} engine]")
+        
+        try:
+            while not self.stop_event.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        
+        self.print_info("Shutting down: draining alerts and saving state...")
+        self.stop_monitor_engine()
+        self.state_store.close()
+        self.alert_history.close()
+        self.print_success("Monitoring stopped and state saved")
+        return 0
+
+    # -------------------- Metrics & status --------------------
+    def register_worker(self, profile_id: str, name: str):
+        self.worker_status[profile_id] = {
+            "name": name, "engine": self.engine, "started_at": time.time(),
+            "polls": 0, "interval": CHECK_INTERVAL, "last_poll": None, "last_success": None, "last_error": None, "last_error_at": None,
+        }
+
+    def note_poll_error(self, profile_id: str, error: str):
+        status = self.worker_status.get(profile_id)
+        if status is not None:
+            status["last_error"] = error
+            status["last_error_at"] = time.time()
+
+    def record_poll(self, profile_id: str, started: float, ingested: int):
+        now = time.time()
+        self.metrics.observe("nextdns_poll_duration_seconds", now - started, profile=profile_id)
+        self.metrics.inc("nextdns_logs_ingested_total", ingested, profile=profile_id)
+        status = self.worker_status.get(profile_id)
+        if status is None:
+            return
+        status["polls"] += 1
+        status["last_poll"] = now
+        if status["last_error_at"] is not None and status["last_error_at"] >= started:
+            self.metrics.inc("nextdns_poll_errors_total", profile=profile_id)
+        else:
+            status["last_success"] = now
+
+    def worker_alive(self, profile_id: str, status: Dict[str, Any]) -> bool:
+        last_seen = status["last_poll"] or status["started_at"]
+        interval = status.get("interval") or CHECK_INTERVAL
+        return self.monitoring and time.time() - last_seen < max(3 * interval + HTTP_TIMEOUT, 60)
+
+    def status(self) -> Dict[str, Any]:
+        workers = {}
+        for pid, status in list(self.worker_status.items()):
+            workers[pid] = dict(status, alive=self.worker_alive(pid, status), circuit=self.breaker(pid).state)
+        status = {
+            "monitoring": self.monitoring,
+            "engine": self.engine,
+            "alert_queue_depth": len(self.alert_queue),
+            "workers": workers,
+        }
+        if self.tracer.enabled or self.tracer.samples or self.tracer.sample_profile:
+            status["trace"] = self.tracer.report()
+        return status
+
+    def trace_report(self) -> Dict[str, Any]:
+        return self.tracer.report()
+
+    def analytics_report(self, window: str = "1h", top: int = TOP_K_SHOWN, profile_id: str = None) -> Dict[str, Any]:
+        """Blocked-traffic aggregates for /analytics: every profile, or one profile with its per-minute series."""
+        seconds = ANALYTICS_WINDOWS[window]
+        if profile_id is not None:
+            return self.analytics.summary(profile_id, seconds, top, minutes=True)
+        with self.analytics.lock:
+            profile_ids = list(self.analytics.profiles)
+        profiles = {pid: self.analytics.summary(pid, seconds, top) for pid in profile_ids}
+        return {"window": window, "profiles": {pid: s for pid, s in profiles.items() if s is not None}}
+
+    def query_alert_history(self, **filters) -> list:
+        return self.alert_history.query(**filters)
+
+    def start_trace_sample(self, spec: str, quiet: bool = False):
+        """--trace-sample PROFILE[:POLLS]"""
+        profile_id, _, polls = spec.partition(":")
+        if self.request_trace_sample(profile_id, int(polls) if polls.isdigit() else None):
+            self.print_info(f"Sampling {profile_id} with cProfile / tracemalloc; results go to {self.tracer.path}")
+        elif not quiet:
+            self.print_warning(f"Can't sample {profile_id}: it is not an active monitored profile")
+
+    def request_trace_sample(self, profile_id: str, polls: int = None) -> bool:
+        """Start a cProfile / tracemalloc sample of a profile this process monitors."""
+        if profile_id not in self.monitored_accounts():
+            return False
+        return self.tracer.request_sample(profile_id, polls or TRACE_SAMPLE_POLLS)
+
+    def render_metrics(self) -> str:
+        return self.metrics.render(self.metric_gauges())
+
+    def metric_gauges(self) -> list:
+        gauges = [
+            ("nextdns_alerts_sent_total", {}, self.alerts.sent),
+            ("nextdns_alerts_failed_total", {}, self.alerts.failed),
+            ("nextdns_alerts_coalesced_total", {}, self.alerts.coalesced),
+            ("nextdns_alerts_dropped_total", {}, self.alert_queue.dropped),
+            ("nextdns_alerts_spilled_total", {}, self.alert_queue.spilled),
+            ("nextdns_alert_queue_depth", {}, len(self.alert_queue)),
+            ("nextdns_alerts_pending", {}, len(self.alerts.pending)),
+            ("nextdns_alert_history_written_total", {}, self.alert_history.written),
+            ("nextdns_alert_history_dropped_total", {}, self.alert_history.dropped),
+        ]
+        with self.state_lock:
+            gauges += [("nextdns_dedupe_entries", {"profile": pid}, len(cache))
+                       for pid, cache in self.processed_requests.items()]
+        with self.snapshot_lock:
+            gauges += [("nextdns_denylist_entries", {"profile": pid}, snap["denylist_size"])
+                       for pid, snap in self.snapshots.items() if "denylist_size" in snap]
+        for pid, status in list(self.worker_status.items()):
+            gauges.append(("nextdns_worker_up", {"profile": pid}, int(self.worker_alive(pid, status))))
+            gauges.append(("nextdns_circuit_open", {"profile": pid}, int(self.breaker(pid).state == "open")))
+            if status["last_success"]:
+                gauges.append(("nextdns_last_successful_poll_timestamp_seconds", {"profile": pid}, status["last_success"]))
+        return gauges
+
     # -------------------- Main Menu --------------------
     def main_menu(self):
         while True:
@@ -803,6 +3549,7 @@ class NextDNSManager:
                 print("\n👋 Goodbye!")
                 # Save state before exiting
                 self.save_state()
+                self.state_store.close()
                 time.sleep(1)
                 break
             else:
@@ -810,9 +3557,290 @@ class NextDNSManager:
                 self.wait_for_enter()
 
 
+def run_shard(index: int, count: int, options: Dict[str, Any], reports):
+    """Entry point of one shard process: serve its slice of the accounts and report metrics upstream."""
+    options = dict(options)
+    trace_sample = options.pop("trace_sample", None)
+    shard_manager = NextDNSManager(shard=(index, count), **options)
+    if trace_sample:
+        # only the shard owning the profile takes the sample
+        shard_manager.start_trace_sample(trace_sample, quiet=True)
+
+    def report():
+        while True:
+            try:
+                reports.put_nowait((index, {
+                    "metrics": shard_manager.metrics.export(),
+                    "gauges": shard_manager.metric_gauges(),
+                    "status": shard_manager.status(),
+                    "analytics": {window: shard_manager.analytics_report(window)["profiles"]
+                                  for window in ANALYTICS_WINDOWS},
+                    "at": time.time(),
+                }))
+            except Exception:
+                pass
+            time.sleep(SHARD_REPORT_INTERVAL)
+
+    sys.stdout.reconfigure(line_buffering=True)
+    threading.Thread(target=report, daemon=True).start()
+    sys.exit(shard_manager.serve())
+
+
+class ShardSupervisor:
+    """
+    Runs the monitor as N processes, each owning the profiles the hash ring assigns to it.
+    Restarts shards that die (with exponential backoff while they keep crashing) and
+    aggregates their metrics/status for the web endpoints.
+    """
+
+    def __init__(self, shards: int, options: Dict[str, Any]):
+        self.shards = shards
+        self.options = options
+        self.context = multiprocessing.get_context("spawn")
+        self.reports = self.context.Queue(maxsize=shards * 4)
+        self.processes: Dict[int, Any] = {}
+        self.restarts: Dict[int, int] = {i: 0 for i in range(shards)}
+        self.crashes: Dict[int, int] = {i: 0 for i in range(shards)}  # deaths in a row, each soon after start
+        self.started_at: Dict[int, float] = {}
+        self.restart_at: Dict[int, float] = {}
+        self.latest: Dict[int, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.alert_history: AlertHistory = None  # opened on the first /alerts query
+
+    def start_shard(self, index: int):
+        process = self.context.Process(target=run_shard, args=(index, self.shards, self.options, self.reports),
+                                       name="nextdns-shard-{}".format(index), daemon=False)
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.time()
+
+    def check_shard(self, index: int, process):
+        """Schedule a dead shard's restart with backoff, and restart it once that is due."""
+        now = time.time()
+        if index not in self.restart_at:
+            if now - self.started_at[index] >= SHARD_STABLE_SECONDS:
+                self.crashes[index] = 0
+            delay = min(SHARD_RESTART_MAX, SHARD_RESTART_BASE * 2 ** self.crashes[index])
+            self.crashes[index] += 1
+            self.restart_at[index] = now + delay
+            print(f"⚠️  Shard {index} exited with code {process.exitcode}; restarting in {delay}s")
+        elif now >= self.restart_at[index]:
+            del self.restart_at[index]
+            self.restarts[index] += 1
+            self.start_shard(index)
+
+    def collect_reports(self):
+        while not self.stop_event.is_set():
+            try:
+                index, report = self.reports.get(timeout=1)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                self.latest[index] = report
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop_event.set())
+        print(f"ℹ️  Starting {self.shards} monitor shards [{self.options.get('engine')} engine]")
+        for index in range(self.shards):
+            self.start_shard(index)
+        threading.Thread(target=self.collect_reports, daemon=True).start()
+        
+        try:
+            while not self.stop_event.wait(1):
+                for index, process in list(self.processes.items()):
+                    if not process.is_alive():
+                        self.check_shard(index, process)
+        except KeyboardInterrupt:
+            self.stop_event.set()
+        
+        # SIGTERM lets each shard drain its alerts and flush its state
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=HTTP_TIMEOUT * 3)
+        print("✅ All shards stopped")
+        return 0
+
+    def render_metrics(self) -> str:
+        combined = Metrics()
+        gauges = []
+        with self.lock:
+            latest = dict(self.latest)
+        for index in range(self.shards):
+            process = self.processes.get(index)
+            gauges.append(("nextdns_shard_up", {"shard": index}, int(bool(process and process.is_alive()))))
+            gauges.append(("nextdns_shard_restarts_total", {"shard": index}, self.restarts[index]))
+            report = latest.get(index)
+            if report:
+                combined.absorb(report["metrics"])
+                gauges += [(name, dict(labels, shard=index), value) for name, labels, value in report["gauges"]]
+        return combined.render(gauges)
+
+    def status(self) -> Dict[str, Any]:
+        with self.lock:
+            latest = dict(self.latest)
+        shards, workers = {}, {}
+        for index in range(self.shards):
+            process = self.processes.get(index)
+            report = latest.get(index) or {}
+            shard_status = report.get("status") or {}
+            shards[index] = {
+                "pid": process.pid if process else None,
+                "alive": bool(process and process.is_alive()),
+                "restarts": self.restarts[index],
+                "last_report": report.get("at"),
+                "alert_queue_depth": shard_status.get("alert_queue_depth", 0),
+            }
+            if shard_status.get("trace"):
+                shards[index]["trace"] = shard_status["trace"]
+            for pid, worker in (shard_status.get("workers") or {}).items():
+                workers[pid] = dict(worker, shard=index)
+        return {
+            "monitoring": not self.stop_event.is_set(),
+            "engine": self.options.get("engine"),
+            "shards": shards,
+            "workers": workers,
+        }
+
+    def trace_report(self) -> Dict[str, Any]:
+        """Each shard's tracer report, as of its last status report."""
+        with self.lock:
+            latest = dict(self.latest)
+        return {index: (report.get("status") or {}).get("trace") for index, report in latest.items()}
+
+    def request_trace_sample(self, profile_id: str, polls: int = None) -> bool:
+        # samples run inside the shard processes; start them there with --trace-sample
+        return False
+
+    def analytics_report(self, window: str = "1h", top: int = TOP_K_SHOWN, profile_id: str = None) -> Dict[str, Any]:
+        """The shards' analytics as of their last report (top lists capped at TOP_K_SHOWN, no per-minute series)."""
+        with self.lock:
+            latest = dict(self.latest)
+        profiles = {}
+        for report in latest.values():
+            for pid, summary in (report.get("analytics") or {}).get(window, {}).items():
+                profiles[pid] = dict(summary, top_domains=summary["top_domains"][:top],
+                                     top_clients=summary["top_clients"][:top])
+        if profile_id is not None:
+            return profiles.get(profile_id)
+        return {"window": window, "profiles": profiles}
+
+    def query_alert_history(self, **filters) -> list:
+        """The shards write to one alerts.db, so the supervisor can query it directly."""
+        with self.lock:
+            if self.alert_history is None:
+                self.alert_history = AlertHistory(ALERT_HISTORY_FILE, self.options.get("alert_history_days"))
+        return self.alert_history.query(**filters)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="NextDNS Custom Denylist Monitor")
+    parser.add_argument("command", nargs="?", choices=("menu", "serve", "discover", "alerts"), default="menu",
+                        help="interactive menu (default), headless monitoring service, "
+                             "re-discover the profiles behind every saved API key, or query the alert history")
+    parser.add_argument("--engine", choices=MONITOR_ENGINES, default="thread",
+                        help="monitoring engine: adaptive polling on a thread pool, one asyncio event loop for all "
+                             "profiles, or one server-sent-events log stream per profile (polling as fallback)")
+    parser.add_argument("--alert-overflow", choices=ALERT_OVERFLOW_POLICIES, default="drop-oldest",
+                        help="what to do when the alert queue is full")
+    parser.add_argument("--state-backend", choices=STATE_BACKENDS, default="json",
+                        help="state.json rewritten on save, or state.db (SQLite, WAL) written per change")
+    parser.add_argument("--api-rps", type=float, default=API_REQUESTS_PER_SECOND,
+                        help="global NextDNS requests-per-second budget across all API keys (0 = unlimited)")
+    parser.add_argument("--api-key-rps", type=float, default=API_KEY_REQUESTS_PER_SECOND,
+                        help="requests-per-second budget shared by the profiles behind one API key (0 = unlimited)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="serve mode: split accounts across N monitor processes by consistent hashing")
+    parser.add_argument("--trace", action="store_true",
+                        help="time each pipeline stage (fetch, decode, match, dedupe, denylist, send, save_state); "
+                             "shown on /trace and /status and dumped to --trace-file")
+    parser.add_argument("--trace-file", default=TRACE_FILE, help="where stage timings and samples are written")
+    parser.add_argument("--trace-sample", metavar="PROFILE[:POLLS]",
+                        help="run cProfile and tracemalloc over the first POLLS polls of one profile "
+                             "(default {})".format(TRACE_SAMPLE_POLLS))
+    parser.add_argument("--alert-history-days", type=float, default=ALERT_HISTORY_RETENTION_DAYS,
+                        help="days of alerts kept in {} (0 = keep forever)".format(ALERT_HISTORY_FILE))
+    history = parser.add_argument_group("alerts command filters")
+    history.add_argument("--profile", help="only this profile id")
+    history.add_argument("--domain", help="only this domain")
+    history.add_argument("--subdomains", action="store_true", help="include subdomains of --domain")
+    history.add_argument("--client", help="only this client IP")
+    history.add_argument("--since", help="relative age (30m, 24h, 7d) or ISO date/time")
+    history.add_argument("--until", help="relative age or ISO date/time")
+    history.add_argument("--by", choices=ALERT_HISTORY_GROUPS, help="one row per distinct value, most hits first")
+    history.add_argument("--limit", type=int, default=50)
+    return parser.parse_args(argv)
+
+
+def show_alert_history(args) -> int:
+    """The `alerts` command: query alerts.db without starting the manager."""
+    if not os.path.exists(ALERT_HISTORY_FILE):
+        print(f"⚠️  No alert history yet ({ALERT_HISTORY_FILE} does not exist)")
+        return 1
+    history = AlertHistory(ALERT_HISTORY_FILE, args.alert_history_days)
+    try:
+        started = time.perf_counter()
+        rows = history.query(profile_id=args.profile, domain=args.domain, subdomains=args.subdomains,
+                             client_ip=args.client, since=parse_since(args.since) if args.since else None,
+                             until=parse_since(args.until) if args.until else None, group_by=args.by,
+                             limit=args.limit)
+        elapsed = (time.perf_counter() - started) * 1000
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+    finally:
+        history.close()
+    def when(ts: float) -> str:
+        return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+    if args.by:
+        print(f"{args.by:<40} {'hits':>8}  {'first':<19}  {'last':<19}")
+        for row in rows:
+            print(f"{row[args.by]:<40} {row['hits']:>8}  {when(row['first'])}  {when(row['last'])}")
+    else:
+        print(f"{'time':<19}  {'profile':<10} {'domain':<40} {'client':<16} device")
+        for row in rows:
+            print(f"{when(row['at'])}  {row['profile_id']:<10} {row['domain']:<40} {row['client_ip']:<16} {row['device']}")
+    print(f"\n{len(rows)} row(s) in {elapsed:.1f} ms")
+    return 0
+
+
 def main():
+    global manager
+    args = parse_args()
+    if args.command == "alerts":
+        sys.exit(show_alert_history(args))
+    if args.command == "serve" and args.shards > 1:
+        # the supervisor answers /metrics and /status with the shards' aggregated data
+        manager = ShardSupervisor(args.shards, {
+            "engine": args.engine, "alert_overflow": args.alert_overflow, "state_backend": args.state_backend,
+            "api_rps": args.api_rps, "api_key_rps": args.api_key_rps, "trace": args.trace,
+            "trace_file": args.trace_file, "trace_sample": args.trace_sample,
+            "alert_history_days": args.alert_history_days,
+        })
+        start_web_server()
+        sys.stdout.reconfigure(line_buffering=True)
+        sys.exit(manager.run())
     try:
-        manager = NextDNSManager()
+        manager = NextDNSManager(engine=args.engine, alert_overflow=args.alert_overflow,
+                                 state_backend=args.state_backend, api_rps=args.api_rps,
+                                 api_key_rps=args.api_key_rps, trace=args.trace, trace_file=args.trace_file,
+                                 alert_history_days=args.alert_history_days)
+        if args.trace_sample:
+            manager.start_trace_sample(args.trace_sample)
+        if args.command == "discover":
+            manager.refresh_profiles()
+            manager.state_store.close()
+            sys.exit(0)
+        start_web_server()
+        if args.command == "serve":
+            # log lines should reach the platform's log drain immediately
+            sys.stdout.reconfigure(line_buffering=True)
+            sys.exit(manager.serve())
         manager.clear_screen()
         print("🚀 NextDNS Manager Starting...")
         time.sleep(1)